@@ -0,0 +1,39 @@
+class BranchGraph:
+    '''The active LTS branches of a package: their order, oldest first, and
+    the commit each one is at locally and on origin (None where the branch
+    does not exist).'''
+
+    def __init__(self, active, local, remote):
+        self.active = active
+        self.position = {branch: i for i, branch in enumerate(active)}
+        self.local = local
+        self.remote = remote
+
+    @classmethod
+    def build(cls, active, refs):
+        local = {b: refs.get('refs/heads/'+b) for b in active}
+        remote = {b: refs.get('refs/remotes/origin/'+b) for b in active}
+        return cls(active, local, remote)
+
+    def prev(self, branch):
+        # The next older active branch, None for the oldest. Raises
+        # ValueError if branch is not active.
+        i = self.index(branch)
+        return self.active[i-1] if i > 0 else None
+
+    def next(self, branch):
+        i = self.index(branch)
+        return self.active[i+1] if i < len(self.active)-1 else None
+
+    def index(self, branch):
+        try:
+            return self.position[branch]
+        except KeyError:
+            raise ValueError('{} is not an active branch'.format(branch))
+
+    def toJSON(self):
+        return {'active': self.active, 'local': self.local, 'remote': self.remote}
+
+    @classmethod
+    def fromJSON(cls, data):
+        return cls(data['active'], data['local'], data['remote'])
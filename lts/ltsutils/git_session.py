@@ -0,0 +1,126 @@
+import pathlib
+from subprocess import PIPE
+
+class GitSession:
+    '''Answers a repository's object and ref queries without a git process per query.
+
+    Object contents come from one long-lived "git cat-file --batch" process,
+    object ids from a "git cat-file --batch-check" one.
+    Refs are listed by a single "git for-each-ref" the first time they are
+    needed and cached until the packed-refs file or the refs/heads and
+    refs/remotes/origin directories change, or invalidate() is called.
+    Branches nested below those directories (e.g. "foo/bar") are not
+    watched. HEAD is read from the git directory on every call, so it is
+    never stale.
+    '''
+
+    def __init__(self, sh):
+        self.sh = sh
+        self._batch = None
+        self._check = None
+        self._refs = None
+        self._refs_signature = None
+        self._git_dir = None
+        self._common_dir = None
+
+    def gitDir(self):
+        if self._git_dir is None:
+            dot_git = pathlib.Path(self.sh.cwd or '.').absolute() / '.git'
+            if dot_git.is_dir():
+                self._git_dir = dot_git
+            else:
+                # a worktree, or a directory below the top level
+                self._git_dir = pathlib.Path(self.sh.run('git rev-parse --absolute-git-dir').stdout.strip())
+        return self._git_dir
+
+    def commonDir(self):
+        # Where refs live: the main repository's git directory for a worktree
+        if self._common_dir is None:
+            try:
+                common = (self.gitDir() / 'commondir').read_text().strip()
+                self._common_dir = (self.gitDir() / common).resolve()
+            except FileNotFoundError:
+                self._common_dir = self.gitDir()
+        return self._common_dir
+
+    def refsSignature(self):
+        # Changes whenever a branch or an origin branch is created, moved or
+        # deleted, or the refs are packed
+        signature = []
+        for path in ('packed-refs', 'refs/heads', 'refs/remotes/origin'):
+            try:
+                signature.append((self.commonDir() / path).stat().st_mtime_ns)
+            except FileNotFoundError:
+                signature.append(0)
+        return signature
+
+    def symbolicRef(self, name='HEAD'):
+        # The ref name points to, or None when it is detached or missing
+        try:
+            text = (self.gitDir() / name).read_text().strip()
+        except FileNotFoundError:
+            return None
+        if not text.startswith('ref: '):
+            return None
+        return text[len('ref: '):]
+
+    def refs(self):
+        # {refname: commit} for every ref
+        signature = self.refsSignature()
+        if self._refs is None or signature != self._refs_signature:
+            self._refs_signature = signature
+            out = self.sh.run_args(['git', 'for-each-ref', '--format=%(objectname) %(refname)']).stdout
+            self._refs = {}
+            for line in out.splitlines():
+                sha, ref = line.split(' ', 1)
+                self._refs[ref] = sha
+        return self._refs
+
+    def invalidate(self):
+        self._refs = None
+
+    def catFile(self, rev):
+        # Contents of the object rev names (e.g. "HEAD:foo.spec") as bytes,
+        # or None when there is no such object
+        return self.readObject(rev)[1]
+
+    def readObject(self, rev):
+        # (object id, contents) of the object rev names, or (None, None)
+        if self._batch is None or self._batch.poll() is not None:
+            self._batch = self.sh.popen(['git', 'cat-file', '--batch'], stdin=PIPE, stdout=PIPE)
+        header = self._query(self._batch, rev)
+        if header is None:
+            return None, None
+        data = self._batch.stdout.read(int(header[2]))
+        self._batch.stdout.read(1)
+        return header[0].decode(), data
+
+    def objectId(self, rev):
+        # Id of the object rev names without reading it, or None
+        if self._check is None or self._check.poll() is not None:
+            self._check = self.sh.popen(['git', 'cat-file', '--batch-check'], stdin=PIPE, stdout=PIPE)
+        header = self._query(self._check, rev)
+        return header[0].decode() if header else None
+
+    def _query(self, proc, rev):
+        proc.stdin.write(rev.encode() + b'\n')
+        proc.stdin.flush()
+        header = proc.stdout.readline().split()
+        # "<sha> <type> <size>", or "<rev> missing" / "<rev> ambiguous"
+        if len(header) != 3 or header[-1] in (b'missing', b'ambiguous'):
+            return None
+        return header
+
+    def close(self):
+        for proc in (self._batch, self._check):
+            if proc is not None:
+                proc.stdin.close()
+                proc.stdout.close()
+                proc.wait()
+        self._batch = self._check = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
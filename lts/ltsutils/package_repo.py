@@ -1,45 +1,237 @@
-import pathlib
-from subprocess import PIPE, CalledProcessError
+import json, os, pathlib, re, tempfile
 from .shell import Shell
+from .git_session import GitSession
+from .branch_graph import BranchGraph
+
+# Bump when the cached NVRs may differ from what getNVR() computes now
+NVR_CACHE_VERSION = 1
+NVR_TAG = re.compile(r'(Name|Version|Release)\s*:\s*(\S+)\s*$', re.IGNORECASE)
+PREAMBLE_END = re.compile(r'%(package|description|prep|build|install|check|files|changelog)\b')
+
+# The exported symbols autospec commits, as "soname:symbol" lines
+SYMBOLS_FILES = ('symbols', 'symbols32')
+
+# active-branches files read by this process: {path: (mtime, branches)}
+_active_branches = {}
+
+def read_active_branches(path):
+    '''The branches listed in an active-branches file, read again only
+    when its mtime changes.'''
+    mtime = path.stat().st_mtime_ns
+    cached = _active_branches.get(path)
+    if cached is None or cached[0] != mtime:
+        with path.open() as f:
+            cached = _active_branches[path] = (mtime, [line.rstrip() for line in f])
+    return cached[1]
+
+def parse_symbols(text):
+    '''{soname: set of symbols} from a symbols file.'''
+    symbols = {}
+    for line in text.splitlines():
+        soname, sep, symbol = line.strip().partition(':')
+        if sep:
+            symbols.setdefault(soname, set()).add(symbol)
+    return symbols
+
+def parse_nvr(spec):
+    '''Name, version and release from the preamble of spec, for specs like
+    the ones autospec writes: each tag given once, without macros or
+    conditionals. Returns None for anything else, which needs rpmspec.'''
+    tags = {}
+    for line in spec.splitlines():
+        if PREAMBLE_END.match(line):
+            break
+        if line.startswith('%if'):
+            return None
+        m = NVR_TAG.match(line)
+        if m:
+            tag, value = m.group(1).lower(), m.group(2)
+            if tag in tags or '%' in value:
+                return None
+            tags[tag] = value
+    if len(tags) != 3:
+        return None
+    return tags['name'], tags['version'], tags['release']
 
 class PackageRepo:
     '''Represents a package repository. Most methods are wrappers of git commands.'''
     class UnknownCurrentBranchException(Exception): pass
     class InvalidBranchException(Exception): pass
+    class MissingSpecException(Exception): pass
 
     def __init__(self, name, path):
         self.name = name
         self.path = pathlib.Path(path)
         self.sh = Shell(self.path)
+        self.git = GitSession(self.sh)
+        self._nvr_cache = None
+        self._symbols = {}
+        self._graph = None
+
+    def close(self):
+        self.git.close()
+
+    def getSpecObject(self, commit='HEAD'):
+        # (blob id, text) of the spec file at commit
+        blob, spec = self.git.readObject('{}:{}.spec'.format(commit, self.name))
+        if spec is None:
+            raise self.MissingSpecException('{}:{}.spec'.format(commit, self.name))
+        return blob, spec.decode()
+
+    def getSpec(self, commit='HEAD'):
+        return self.getSpecObject(commit)[1]
 
     def getNVR(self, commit='HEAD'):
-        with self.sh.popen(['git', 'show', '{}:{}.spec'.format(commit, self.name)], stdout=PIPE) as specfile:
-            nvr = self.sh.run('rpmspec --srpm -q --queryformat %{NVR} /dev/stdin', stdin=specfile.stdout)
-        return tuple(nvr.stdout.strip().rsplit('-', maxsplit=2))
+        # NVRs are cached by spec blob id in the git directory, so a spec
+        # is only evaluated once across runs and branches
+        blob, spec = self.getSpecObject(commit)
+        cache = self.nvrCache()
+        if blob in cache:
+            return tuple(cache[blob])
+        nvr = parse_nvr(spec)
+        if nvr is None:
+            out = self.sh.run('rpmspec --srpm -q --queryformat %{NVR} /dev/stdin', input=spec)
+            nvr = tuple(out.stdout.strip().rsplit('-', maxsplit=2))
+        cache[blob] = nvr
+        self.saveNVRCache()
+        return nvr
+
+    def nvrCachePath(self):
+        return self.git.gitDir() / 'lts-nvr-cache.json'
+
+    def nvrCache(self):
+        if self._nvr_cache is None:
+            try:
+                with self.nvrCachePath().open() as f:
+                    data = json.load(f)
+                if data.get('version') != NVR_CACHE_VERSION:
+                    raise ValueError
+                self._nvr_cache = data['nvr']
+            except (OSError, ValueError, KeyError, AttributeError):
+                self._nvr_cache = {}
+        return self._nvr_cache
+
+    def saveNVRCache(self):
+        # Written atomically; a cache that can't be written is only slower
+        path = self.nvrCachePath()
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=path.parent, prefix=path.name+'.', delete=False) as f:
+                json.dump({'version': NVR_CACHE_VERSION, 'nvr': self._nvr_cache}, f)
+            os.replace(f.name, path)
+        except OSError:
+            pass
+
+    def symbolsIndexPath(self, blob):
+        return self.git.gitDir() / 'lts-symbols' / (blob + '.json')
+
+    def getSymbols(self, commit='HEAD'):
+        '''{file: {soname: set of symbols}} for the symbols files at commit.
+
+        Each symbols file is parsed once and indexed on disk in the git
+        directory by its blob id, so every branch and commit sharing the
+        file shares the index entry, and later runs only load it.'''
+        symbols = {}
+        for name in SYMBOLS_FILES:
+            blob = self.git.objectId('{}:{}'.format(commit, name))
+            if blob is None:
+                continue
+            if blob not in self._symbols:
+                self._symbols[blob] = self.loadSymbolsIndex(blob)
+            symbols[name] = self._symbols[blob]
+        return symbols
+
+    def loadSymbolsIndex(self, blob):
+        path = self.symbolsIndexPath(blob)
+        try:
+            with path.open() as f:
+                return {soname: set(names) for soname, names in json.load(f).items()}
+        except (OSError, ValueError):
+            pass
+        symbols = parse_symbols(self.git.catFile(blob).decode())
+        try:
+            path.parent.mkdir(exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=path.parent, prefix='.', delete=False) as f:
+                json.dump({soname: sorted(names) for soname, names in symbols.items()}, f, separators=(',', ':'))
+            os.replace(f.name, path)
+        except OSError:
+            pass
+        return symbols
+
+    def missingSymbols(self, old, new):
+        '''The "file soname:symbol" entries exported at commit new but not at
+        old, i.e. what a binary built from old lacks to stand in for one
+        built from new. None when new has no symbols files to compare.'''
+        new_symbols = self.getSymbols(new)
+        if not new_symbols:
+            return None
+        old_symbols = self.getSymbols(old)
+        missing = []
+        for name, sonames in sorted(new_symbols.items()):
+            old_sonames = old_symbols.get(name, {})
+            for soname, names in sorted(sonames.items()):
+                for symbol in sorted(names - old_sonames.get(soname, set())):
+                    missing.append('{} {}:{}'.format(name, soname, symbol))
+        return missing
 
     def checkoutBranch(self, branch, allow_remote=False):
         # allow_remote=True allows checking out a new remote-tracking branch
         if not allow_remote and not self.hasBranch(branch):
             raise self.InvalidBranchException(branch)
-        self.sh.run_args(['git', 'checkout', branch], capture_output=False)
+        try:
+            self.sh.run_args(['git', 'checkout', branch], capture_output=False)
+        finally:
+            # checking out a remote-tracking branch creates a local one
+            self.git.invalidate()
 
     def fastForwardBranch(self, old, new):
         self.checkoutBranch(old)
         if not self.hasBranch(new):
             raise self.InvalidBranchException(new)
-        self.sh.run_args(['git', 'merge', '--ff-only', new], capture_output=False)
+        try:
+            self.sh.run_args(['git', 'merge', '--ff-only', new], capture_output=False)
+        finally:
+            self.git.invalidate()
 
-    def getActiveBranches(self):
+    def activeBranchesPath(self):
         toplvl = pathlib.Path(self.path) / '../..'
         common = toplvl / 'projects/common'
-        active_branches = common / 'lts/active-branches'
-        with active_branches.open() as f:
-            return [line.rstrip() for line in f]
+        return (common / 'lts/active-branches').resolve()
 
-    def getCurrentBranch(self):
+    def getActiveBranches(self):
+        return list(read_active_branches(self.activeBranchesPath()))
+
+    def getBranchGraph(self):
+        '''The BranchGraph of the active branches. It is kept in memory and
+        in the git directory, and rebuilt when the active-branches file or
+        the refs change (see GitSession.refsSignature()).'''
+        path = self.activeBranchesPath()
+        signature = [str(path), path.stat().st_mtime_ns] + self.git.refsSignature()
+        if self._graph is not None and self._graph[0] == signature:
+            return self._graph[1]
+
+        index = self.git.gitDir() / 'lts-branches.json'
+        graph = None
         try:
-            head = self.sh.run('git symbolic-ref HEAD').stdout.strip()
-        except CalledProcessError:
+            with index.open() as f:
+                data = json.load(f)
+            if data['signature'] == signature:
+                graph = BranchGraph.fromJSON(data['graph'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        if graph is None:
+            graph = BranchGraph.build(read_active_branches(path), self.git.refs())
+            try:
+                with tempfile.NamedTemporaryFile('w', dir=index.parent, prefix=index.name+'.', delete=False) as f:
+                    json.dump({'signature': signature, 'graph': graph.toJSON()}, f)
+                os.replace(f.name, index)
+            except OSError:
+                pass
+        self._graph = (signature, graph)
+        return graph
+
+    def getCurrentBranch(self):
+        head = self.git.symbolicRef('HEAD')
+        if head is None:
             raise self.UnknownCurrentBranchException
 
         refs_heads = 'refs/heads/'
@@ -48,5 +240,4 @@ class PackageRepo:
         return head
 
     def hasBranch(self, branch):
-        p = self.sh.run_args(['git', 'rev-parse', 'refs/heads/'+branch], check=False)
-        return p.returncode == 0
+        return 'refs/heads/'+branch in self.git.refs()
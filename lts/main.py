@@ -1,14 +1,35 @@
 #!/usr/bin/python
-import sys,argparse
+import sys,argparse,pathlib
+import concurrent.futures, contextlib, io, json
 
 from ltsutils.package_repo import PackageRepo
 
+# Commands that can run over every package with --fleet
+FLEET_COMMANDS = ('sanity-check', 'is-same-version', 'can-reuse-binary', 'current-branch', 'nvr')
+
+common = pathlib.Path(__file__).resolve().parent.parent
+
 def log(msg, **kwargs):
     print(msg, file=sys.stderr)
 
-def init_parser():
-    main = argparse.ArgumentParser()
-    main.add_argument('package_name', nargs=1)
+def fleet_options():
+    p = argparse.ArgumentParser(add_help=False)
+    p.add_argument('--fleet', action='store_true',
+            help='run the command on every package in --packages-file instead of one package in .')
+    p.add_argument('--packages-file', default=str(common / 'packages'),
+            help='with --fleet, list of package names (default: %(default)s)')
+    p.add_argument('--packages-dir', default=str(common.parent.parent / 'packages'),
+            help='with --fleet, where the package repos are checked out (default: %(default)s)')
+    p.add_argument('-j', '--jobs', type=int, default=None,
+            help='with --fleet, number of worker processes (default: number of CPUs)')
+    p.add_argument('--format', choices=('tsv', 'json'), default='tsv',
+            help='with --fleet, report format (default: %(default)s)')
+    return p
+
+def init_parser(fleet=False):
+    main = argparse.ArgumentParser(parents=[fleet_options()])
+    if not fleet:
+        main.add_argument('package_name', nargs=1)
     subparsers = main.add_subparsers(dest='command', metavar='command', required=True)
 
     # Package maintenance commands
@@ -31,6 +52,9 @@ def init_parser():
     p = subparsers.add_parser('can-reuse-binary',
             help='check if binary from another branch can be used in current branch')
     p.add_argument('branch', nargs=1)
+    p = subparsers.add_parser('nvr',
+            help='show name-version-release of the package on the given branch')
+    p.add_argument('branch', nargs=1)
 
     # Other commands
     p = subparsers.add_parser('prompt',
@@ -41,29 +65,27 @@ def init_parser():
     return main
 
 def prev_branch(args, repo):
-    active_branches = repo.getActiveBranches()
+    graph = repo.getBranchGraph()
     current = repo.getCurrentBranch()
 
-    i = active_branches.index(current)
-    if i == 0:
+    prev = graph.prev(current)
+    if prev is None:
         log('Already on oldest active branch.')
         return False
 
-    prev = active_branches[i-1]
     print(prev)
     if args.checkout:
         repo.checkoutBranch(prev, allow_remote=True)
 
 def next_branch(args, repo):
-    active_branches = repo.getActiveBranches()
+    graph = repo.getBranchGraph()
     current = repo.getCurrentBranch()
 
-    i = active_branches.index(current)
-    if i == len(active_branches)-1:
+    next_ = graph.next(current)
+    if next_ is None:
         log('Already on newest active branch.')
         return False
 
-    next_ = active_branches[i+1]
     print(next_)
     if args.checkout:
         repo.checkoutBranch(next_, allow_remote=False)
@@ -72,7 +94,7 @@ def current_branch(args, repo):
     current = repo.getCurrentBranch()
     print(current)
 
-def is_same_version(args, other):
+def is_same_version(args, repo):
     current = repo.getCurrentBranch()
     other = args.branch[0]
     assert repo.hasBranch(other), 'Branch %s not found' % other
@@ -100,7 +122,7 @@ def sanity_check(args, repo):
         ok = False
 
     # active-branches file must not be empty
-    active_branches = repo.getActiveBranches()
+    active_branches = repo.getBranchGraph().position
     if not len(active_branches):
         log('No active branches defined. Is active-branches file empty?')
         ok = False
@@ -112,12 +134,35 @@ def sanity_check(args, repo):
     return ok
 
 def can_reuse_binary(args, repo):
-    # Just compare versions for now
-    # TODO: ABI compatibility testing
+    # A binary built from the same commit can always be reused. One built
+    # from a different commit, whatever its version, can if its libraries
+    # export everything the current branch's would, going by the symbols
+    # files autospec commits. lts-build then tags the other branch's NVR
+    # (see the nvr command) into the current branch.
     current = repo.getCurrentBranch()
     older = args.branch[0]
-    v1, v2 = [repo.getNVR('refs/heads/'+b)[1] for b in (older, current)]
-    return v1 == v2
+    refs = repo.git.refs()
+    old_ref, new_ref = 'refs/heads/'+older, 'refs/heads/'+current
+    if refs.get(old_ref) == refs.get(new_ref):
+        return True
+
+    v1, v2 = ['-'.join(repo.getNVR(r)) for r in (old_ref, new_ref)]
+    missing = repo.missingSymbols(old_ref, new_ref)
+    if missing is None:
+        log('{} on {} is built from a different commit than {} and there are no symbols files to compare ABI.'.format(v1, older, v2))
+        return False
+    if missing:
+        log('{} on {} lacks {} symbols exported by {}, e.g.:'.format(v1, older, len(missing), v2))
+        for m in missing[:10]:
+            log('  ' + m)
+        return False
+    log('{} on {} exports every symbol of {}.'.format(v1, older, v2))
+    return True
+
+def nvr(args, repo):
+    branch = args.branch[0]
+    assert repo.hasBranch(branch), 'Branch %s not found' % branch
+    print('-'.join(repo.getNVR('refs/heads/'+branch)))
 
 def prompt(args, repo):
     import selectors
@@ -142,20 +187,71 @@ def prompt(args, repo):
         print('Cancelled.')
         return False
 
+commands = {
+        'prev-branch': prev_branch,
+        'next-branch': next_branch,
+        'current-branch': current_branch,
+        'is-same-version': is_same_version,
+        'fast-forward': fast_forward,
+        'can-reuse-binary': can_reuse_binary,
+        'nvr': nvr,
+        'prompt': prompt,
+        'sanity-check': sanity_check,
+        }
+
+def run_package(args, name):
+    # Fleet worker: run the command on one package, capturing what it
+    # prints. The exit status is what main.py would exit with, or 2 when
+    # the command failed with an exception.
+    path = pathlib.Path(args.packages_dir) / name
+    out, err = io.StringIO(), io.StringIO()
+    status = 0
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        if not path.is_dir():
+            log('Package repo {} not found.'.format(path))
+            status = 2
+        else:
+            repo = PackageRepo(name, path)
+            try:
+                ret = commands[args.command](args, repo)
+                status = 0 if ret is None or ret else 1
+            except Exception as e:
+                log('{}: {}'.format(type(e).__name__, e))
+                status = 2
+            finally:
+                repo.close()
+    return {'package': name, 'exit': status, 'output': out.getvalue().rstrip('\n'),
+            'messages': err.getvalue().rstrip('\n')}
+
+def run_fleet(args):
+    # Run the command on every package in a pool of worker processes and
+    # print one report. Returns whether every package exited with 0.
+    with open(args.packages_file) as f:
+        names = [line.strip() for line in f if line.strip()]
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        results = list(pool.map(run_package, [args] * len(names), names, chunksize=16))
+
+    if args.format == 'json':
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        print('package\texit\toutput\tmessages')
+        for r in results:
+            fields = [r['package'], str(r['exit']), r['output'], r['messages']]
+            print('\t'.join(f.replace('\t', ' ').replace('\n', '; ') for f in fields))
+    return all(r['exit'] == 0 for r in results)
+
 if __name__=='__main__':
-    args = init_parser().parse_args()
-    repo = PackageRepo(args.package_name[0], '.')
+    fleet = fleet_options().parse_known_args()[0].fleet
+    parser = init_parser(fleet)
+    args = parser.parse_args()
 
-    commands = {
-            'prev-branch': prev_branch,
-            'next-branch': next_branch,
-            'current-branch': current_branch,
-            'is-same-version': is_same_version,
-            'fast-forward': fast_forward,
-            'can-reuse-binary': can_reuse_binary,
-            'prompt': prompt,
-            'sanity-check': sanity_check,
-            }
+    if fleet:
+        if args.command not in FLEET_COMMANDS:
+            parser.error('--fleet supports only ' + ', '.join(FLEET_COMMANDS))
+        exit(0 if run_fleet(args) else 1)
+
+    repo = PackageRepo(args.package_name[0], '.')
     ret = commands[args.command](args, repo)
     if ret is not None:
         exit(0 if ret else 1)
@@ -2,8 +2,9 @@ import unittest
 import os, pathlib, tempfile, logging
 import subprocess, functools
 
-from ltsutils.package_repo import PackageRepo
+from ltsutils.package_repo import PackageRepo, parse_nvr, parse_symbols
 import ltsutils.shell
+from ltsutils.branch_graph import BranchGraph
 
 run = functools.partial(subprocess.run, check=True)
 
@@ -55,6 +56,17 @@ class PackageRepoTestCase(LTSUtilsTestCase):
     def testGetNVR(self):
         raise NotImplementedError
 
+    def testNVRCache(self):
+        nvr = self.repo.getNVR('L2')
+        blob = self.sh_stdout('git rev-parse L2:%s.spec' % self.package.name)
+        repo = PackageRepo(self.package.name, self.workdir)
+        self.assertEqual(repo.nvrCache()[blob], list(nvr))
+        self.assertEqual(repo.getNVR('L2'), nvr)
+
+    def testMissingSymbols(self):
+        self.assertEqual(self.repo.missingSymbols('L2', 'L2'), None if not self.repo.getSymbols('L2') else [])
+        self.assertEqual(self.repo.getSymbols('L1:no-such-dir'), {})
+
     def testHasBranch(self):
         self.assertTrue(self.repo.hasBranch('L2'))
         self.assertFalse(self.repo.hasBranch('L3'))
@@ -78,6 +90,19 @@ class PackageRepoTestCase(LTSUtilsTestCase):
         self.sh('git checkout --detach L2')
         self.assertRaises(PackageRepo.UnknownCurrentBranchException, self.repo.getCurrentBranch)
 
+    def testGitSession(self):
+        self.assertEqual(self.repo.git.refs()['refs/heads/L2'], self.L2)
+        spec = self.repo.git.catFile('%s:%s.spec' % (self.L2, self.package.name))
+        self.assertEqual(spec.decode(), self.sh_stdout('git show %s:%s.spec' % (self.L2, self.package.name)) + '\n')
+        self.assertIsNone(self.repo.git.catFile('%s:no-such-file' % self.L2))
+        self.assertRaises(PackageRepo.MissingSpecException, self.repo.getSpec, 'L1:no-such-dir')
+
+        # refs are read once; our own branch changes invalidate them
+        self.sh('git branch L3 L1')
+        self.repo.git.invalidate()
+        self.assertTrue(self.repo.hasBranch('L3'))
+        self.repo.close()
+
 class TestNano(PackageRepoTestCase):
     package = Package('nano')
     package.L1 = '3dcfa09f5217eedf6ec7539af7e243655d3abdb6' # 3.2-54
@@ -95,3 +120,28 @@ class TestMySQL_Python(PackageRepoTestCase):
     def testGetNVR(self):
         nvr = self.repo.getNVR(self.L2)
         self.assertEqual(nvr, ('MySQL-python', '1.2.5', '33'))
+
+class TestParseNVR(unittest.TestCase):
+    def testAutospec(self):
+        spec = 'Name     : nano\nVersion  : 3.2\nRelease  : 55\nURL      : https://nano-editor.org\n\n%description\nRelease: 1\n'
+        self.assertEqual(parse_nvr(spec), ('nano', '3.2', '55'))
+
+    def testNeedsRpmspec(self):
+        self.assertIsNone(parse_nvr('Name: foo\nVersion: %{major}.1\nRelease: 1\n'))
+        self.assertIsNone(parse_nvr('Name: foo\n%if 0\nVersion: 1\n%endif\nRelease: 1\n'))
+        self.assertIsNone(parse_nvr('Name: foo\nVersion: 1\n'))
+
+class TestParseSymbols(unittest.TestCase):
+    def testParse(self):
+        symbols = parse_symbols('libz.so.1:adler32\nlibz.so.1:crc32\nlibzz.so.2:crc32\n\n')
+        self.assertEqual(symbols, {'libz.so.1': {'adler32', 'crc32'}, 'libzz.so.2': {'crc32'}})
+
+class TestBranchGraph(unittest.TestCase):
+    def testOrder(self):
+        refs = {'refs/heads/L1': 'a', 'refs/heads/L2': 'b', 'refs/remotes/origin/L2': 'c'}
+        graph = BranchGraph.build(['L1', 'L2', 'L3'], refs)
+        self.assertEqual((graph.prev('L1'), graph.prev('L2'), graph.next('L2'), graph.next('L3')),
+                         (None, 'L1', 'L3', None))
+        self.assertRaises(ValueError, graph.prev, 'main')
+        self.assertEqual((graph.local['L2'], graph.remote['L2'], graph.local['L3']), ('b', 'c', None))
+        self.assertEqual(BranchGraph.fromJSON(graph.toJSON()).position, graph.position)
@@ -1,179 +1,713 @@
 #!/usr/bin/python3
+import argparse
+import array
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import shlex
+import shutil
 import sys
 import tempfile
+import time
 import subprocess
 
-header = list()
-files = list()
-files_chunks = dict()	# dict to list
-files_header = dict()	# dict to list
 
+class Section:
+    # One "diff --git" section of a patch: its header lines (diff, index,
+    # ---/+++ lines) and its chunks, each a list of lines starting with the
+    # "@@" line.  The patch header is yielded as a section with file None.
+    def __init__(self, file):
+        self.file = file
+        self.header = list()
+        self.chunks = list()
 
+    def push_chunk(self, chunk):
+        if len(chunk) == 0:
+            return
+        self.chunks.append(chunk)
 
-def push_chunk(file, chunk):
-    global files_chunks
-    
-    if len(chunk) == 0:
-        return
-    
-    if file not in files_chunks:
-        files_chunks[file] = list()
-        
-    files_chunks[file].append(chunk)
+
+def section_name(line):
+    # The name a "diff --git" line is filed under: everything from its
+    # first "b/" on, or None when there is none
+    filename = line.replace("diff --git","")
+    index= filename.find("b/")
+    if index < 0:
+        return None
+    return filename[index:].strip()
 
 
 def parse_patch(lines):
-    global header
-    global files
-    global files_chunks
-    global files_header
-    
+    # Generator yielding the sections of a patch as soon as each one is
+    # complete, so only one file's diff is held in memory at a time.
     phase = 0
-    
-    currentfile = ""
+
+    current = Section(None)
     currentchunk = list()
-    
-        
+
     for line in lines:
         line = line.replace("\n","")
-        
+
         if line.startswith("diff --git"):
-        
-            push_chunk(currentfile, currentchunk)
+
+            current.push_chunk(currentchunk)
             currentchunk = list()
-        
-            filename = line.replace("diff --git","")
-            index= filename.find("b/")
-            if index >= 0:
-                filename = filename[index:].strip()
-                currentfile = filename
-                files.append(currentfile)
+
+            filename = section_name(line)
+            if filename is not None:
+                yield current
+                current = Section(filename)
                 phase = 1
-                
+
         if line.startswith("@@"):
-            push_chunk(currentfile, currentchunk)
+            current.push_chunk(currentchunk)
             currentchunk = list()
             phase = 2
-            
-            
-        if phase == 0:
-            header.append(line)
-        if phase == 1:
-            if currentfile not in files_header:
-                files_header[currentfile] = list()
-            files_header[currentfile].append(line) 
+
+
+        if phase == 0 or phase == 1:
+            current.header.append(line)
         if phase == 2:
             currentchunk.append(line)
-        
-    push_chunk(currentfile, currentchunk)
-    currentchunk = list()
 
-def print_all():
-    global header
-    global files
-    global files_chunks
-    global files_header
-
-    for line in header:
-        print(line)
-    for file in files:
-        for line in files_header[file]:
-            print(line)
-        if file in files_chunks:
-            for chunk in files_chunks[file]:
-                for line in chunk:
-                    print(line)
-                    
-                    
-def zap_entire_file(filename):
-    global header
-    global files
-    global files_chunks
-    global files_header
-    if filename in files:
-        files.remove(filename)                
-
-def zap_entire_file_end(filename):
-    global header
-    global files
-    global files_chunks
-    global files_header
-    files_to_remove = list()
-    for file in files:
-        if file.endswith(filename):
-            # Don't modify the original list while iterating over it
-            files_to_remove.append(file)
-    for file in files_to_remove:
-        files.remove(file)                
-            
-def zap_line_in_file_substring(filename, match):
-    global header
-    global files
-    global files_chunks
-    global files_header
-    for file in files:
-        if file.endswith(filename):
-            for chunk in files_chunks[file]:
-                to_delete = list()
-                for line in chunk:
-                    if match in line:
-                        to_delete.append(line)
-                for line in to_delete:
-                    chunk.remove(line)
-            
-
-def zap_line_in_file(filename, match):
-    global header
-    global files
-    global files_chunks
-    global files_header
-    for file in files:
-        if file.endswith(filename):
-            for chunk in files_chunks[filename]:
-                to_delete = list()
-                for line in chunk:
-                    if line == ("+" + match):
-                        to_delete.append(line)
-                    if line == ("-" + match):
-                        to_delete.append(line)
-                for line in to_delete:
-                    chunk.remove(line)
-            
-
-def zap_line_in_file_start(filename, match):
-    global header
-    global files
-    global files_chunks
-    global files_header
-    
-    for file in files:
-        if file.endswith(filename):
-            for chunk in files_chunks[file]:
-                to_remove = list()
-                for line in chunk:
-                    if line.startswith("+" + match):
-                        to_remove.append(line)
-                    if line.startswith("-" + match):
-                        to_remove.append(line)
-                for line in to_remove:
-                    chunk.remove(line)
-            
-def zap_plus_line_in_file(filename):
-    global header
-    global files
-    global files_chunks
-    global files_header
-    
-    for file in files:
-        if file.endswith(filename):
-            for chunk in files_chunks[file]:
-                to_remove = list()
-                for line in chunk:
-                    if line.startswith("+"):
-                        to_remove.append(line)
-                for line in to_remove:
-                    chunk.remove(line)
-            
+    current.push_chunk(currentchunk)
+    yield current
+
+
+def write_patch(sections, out):
+    for section in sections:
+        if section.file is None:
+            # chunk lines before the first file are never printed
+            lines = section.header
+        else:
+            lines = section.header + [line for chunk in section.chunks for line in chunk]
+        if len(lines) > 0:
+            out.write("\n".join(lines) + "\n")
+
+
+def file_lines(filename):
+    with open (filename, "r") as myfile:
+        yield from myfile
+
+
+def git_lines(args, cwd=None):
+    # Stream the output of a git command instead of decoding all of it at
+    # once.  Lines are split on "\n" only and keep it.
+    with subprocess.Popen(["git"] + args, cwd=cwd, stdout=subprocess.PIPE) as proc:
+        yield from io.TextIOWrapper(proc.stdout, encoding="utf-8", errors="replace", newline="\n")
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def format_patch_lines(cwd=None):
+    # Like str.split("\n"), the empty string after a trailing newline is
+    # kept
+    line = "\n"
+    for line in git_lines(["format-patch", "-1", "--stdout"], cwd=cwd):
+        yield line
+    if line.endswith("\n"):
+        yield ""
+
+
+class GitObjects:
+    # Reads objects through one long-running "git cat-file --batch"
+    def __init__(self, cwd=None):
+        self.proc = subprocess.Popen(["git", "cat-file", "--batch"], cwd=cwd,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.oid_size = 20
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+    def read(self, name):
+        # Returns (oid, type, data); raises KeyError for missing objects
+        self.proc.stdin.write(name.encode() + b"\n")
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(name)
+        oid, kind, size = header[0].decode(), header[1].decode(), int(header[2])
+        data = self.proc.stdout.read(size)
+        self.proc.stdout.read(1)
+        self.oid_size = len(oid) // 2
+        return oid, kind, data
+
+    def tree(self, oid):
+        # {name: (mode, oid)} for a tree object, empty for None
+        entries = dict()
+        if oid is None:
+            return entries
+        _, _, data = self.read(oid)
+        pos = 0
+        while pos < len(data):
+            space = data.index(b" ", pos)
+            nul = data.index(b"\0", space)
+            mode = data[pos:space].decode()
+            name = data[space + 1:nul].decode("utf-8", errors="replace")
+            pos = nul + 1 + self.oid_size
+            entries[name] = (mode, data[nul + 1:pos].hex())
+        return entries
+
+    def commit(self, rev):
+        # Returns (oid, headers, message) with headers as {key: [values]}
+        oid, _, data = self.read(rev + "^{commit}")
+        text, _, message = data.decode("utf-8", errors="replace").partition("\n\n")
+        headers = dict()
+        for line in text.split("\n"):
+            if line.startswith(" "):
+                # continuation of a multi-line header such as gpgsig
+                continue
+            key, _, value = line.partition(" ")
+            headers.setdefault(key, list()).append(value)
+        return oid, headers, message
+
+
+def changed_paths(objects, old_tree, new_tree, prefix=""):
+    # Yields (path, old, new) for every non-tree entry that differs between
+    # two trees, in the order git diff lists them.  old and new are
+    # (mode, oid) or None.  Only subtrees whose oids differ are read.
+    old = objects.tree(old_tree)
+    new = objects.tree(new_tree)
+
+    def order(name):
+        # git sorts trees as if their name ended in "/"
+        entry = new.get(name) or old.get(name)
+        return name + "/" if entry[0] == "40000" else name
+
+    for name in sorted(set(old) | set(new), key=order):
+        o = old.get(name)
+        n = new.get(name)
+        if o == n:
+            continue
+        o_tree = o is not None and o[0] == "40000"
+        n_tree = n is not None and n[0] == "40000"
+        if not o_tree and not n_tree:
+            yield prefix + name, o, n
+            continue
+        if not o_tree and o is not None:
+            yield prefix + name, o, None
+        if not n_tree and n is not None:
+            yield prefix + name, None, n
+        yield from changed_paths(objects, o[1] if o_tree else None,
+                                 n[1] if n_tree else None, prefix + name + "/")
+
+
+# Beyond this many bytes of excludes, git diff-tree gets none and the
+# rules drop those files after all, to stay clear of the argument limit
+MAX_EXCLUDE_BYTES = 256 * 1024
+
+
+def dropped_paths(rules, changes):
+    # The changed paths whose diff the rules drop entirely: removed files,
+    # mode-only changes, files whose "+" lines are all zapped.  With both
+    # added and removed files in the commit, git may pair them up as
+    # renames, so only files changed in place are left out then.
+    added = any(old is None for _, old, _ in changes)
+    removed = any(new is None for _, _, new in changes)
+    for path, old, new in changes:
+        if added and removed and (old is None or new is None):
+            continue
+        if new is None or (old is not None and old[1] == new[1]):
+            yield path
+            continue
+        file_rules = rules.for_file(section_name("diff --git a/%s b/%s" % (path, path)))
+        if file_rules is None or file_rules.drop_plus:
+            yield path
+
+
+def commit_lines(rules, cwd=None, rev="HEAD"):
+    # What "git format-patch -1 --stdout --no-stat --no-signature" writes
+    # for rev, without the diffs of the files the rules drop entirely.
+    # Those are found by comparing the trees through the object database
+    # and passed to git diff-tree as excludes, so git never reads or diffs
+    # their blobs.  The headers come from git log, which encodes and folds
+    # them the way format-patch does.
+    with GitObjects(cwd) as objects:
+        oid, headers, _ = objects.commit(rev)
+        parents = headers.get("parent", list())
+        if len(parents) > 1:
+            # format-patch leaves merges out
+            return
+        parent_tree = objects.commit(parents[0])[1]["tree"][0] if parents else None
+        changes = list(changed_paths(objects, parent_tree, headers["tree"][0]))
+    if len(changes) == 0:
+        return
+
+    excludes = [":(exclude,literal)" + path for path in dropped_paths(rules, changes)]
+    if sum(len(exclude) for exclude in excludes) > MAX_EXCLUDE_BYTES:
+        excludes = list()
+    args = ["diff-tree", "-p", "-M", "--no-commit-id"]
+    args += [parents[0], oid] if parents else ["--root", oid]
+    if len(excludes) > 0:
+        args += ["--", "."] + excludes
+
+    yield from git_lines(["log", "-1", "--pretty=email", oid], cwd=cwd)
+    yield ""
+    yield from git_lines(args, cwd=cwd)
+
+
+def trie_regex(strings):
+    # Factor the strings into a prefix trie and emit it as one regex
+    # source, so a match walks the trie once instead of trying every
+    # string in turn.
+    trie = dict()
+    for s in strings:
+        node = trie
+        for c in s:
+            if "" in node:
+                # a shorter string already matches everything below here
+                break
+            node = node.setdefault(c, dict())
+        else:
+            node.clear()
+            node[""] = None
+
+    def build(node):
+        if "" in node:
+            return ""
+        alts = [re.escape(c) + build(child) for c, child in sorted(node.items())]
+        if len(alts) == 1:
+            return alts[0]
+        return "(?:" + "|".join(alts) + ")"
+
+    return build(trie)
+
+
+class FileRules:
+    # The rules that apply to one file, merged from every rule table entry
+    # whose name or suffix matches it.
+    def __init__(self, table, file, exact, prefix, substring, drop_plus):
+        self.table = table
+        self.file = file
+        self.exact = frozenset(exact)
+        self.prefix = prefix.match if prefix else None
+        self.substring = substring.search if substring else None
+        self.drop_plus = drop_plus
+        self.empty = not (exact or prefix or substring or drop_plus)
+
+    def drops(self, line):
+        c = line[:1]
+        if c == "+" or c == "-":
+            if line in self.exact:
+                return True
+            if self.drop_plus and c == "+":
+                return True
+            if self.prefix and self.prefix(line, 1):
+                return True
+        if self.substring and self.substring(line):
+            return True
+        return False
+
+    def filter_chunk(self, chunk):
+        if self.empty:
+            return chunk
+        drops = self.drops
+        return [line for line in chunk if not drops(line)]
+
+    def explain(self, line, seconds):
+        # The slow twin of drops() for --stats: returns the rule dropping
+        # line, or None, and adds the time spent in each matcher to seconds
+        c = line[:1]
+        rule = None
+        if c == "+" or c == "-":
+            start = time.perf_counter()
+            if line in self.exact:
+                rule = self.table.rule_of(self.file, "zap_line_in_file", line[1:])
+            now = time.perf_counter()
+            seconds["zap_line_in_file"] += now - start
+            if rule is None and self.drop_plus and c == "+":
+                rule = self.table.rule_of(self.file, "zap_plus_line_in_file")
+            if rule is None and self.prefix:
+                start = time.perf_counter()
+                m = self.prefix(line, 1)
+                seconds["zap_line_in_file_start"] += time.perf_counter() - start
+                if m:
+                    rule = self.table.rule_of(self.file, "zap_line_in_file_start", m.group())
+        if rule is None and self.substring:
+            start = time.perf_counter()
+            m = self.substring(line)
+            seconds["zap_line_in_file_substring"] += time.perf_counter() - start
+            if m:
+                rule = self.table.rule_of(self.file, "zap_line_in_file_substring", m.group())
+        return rule
+
+
+class RuleTable:
+    # The zap_* methods record rules; nothing is applied until for_file()
+    # compiles the entries that match a given file.  Rules given an exact
+    # file name are keyed by that name, the others by file name suffix.
+    def __init__(self):
+        self.files = set()
+        self.file_suffixes = list()
+        self.exact = dict()		# filename to set of lines
+        self.prefixes = dict()		# suffix to list of prefixes
+        self.substrings = dict()	# suffix to list of substrings
+        self.plus = set()		# suffixes
+        self.patterns = None		# (kind, suffix) to regex, see compile()
+        self.compiled = dict()		# filename to FileRules
+        self.rules = list()		# (name, args) in the order given
+        self.explained = dict()		# for rule_of()
+
+    def changed(self, *rule):
+        self.rules.append((rule[0], rule[1:]))
+        self.patterns = None
+        self.compiled.clear()
+        self.explained.clear()
+
+    def zap_entire_file(self, filename):
+        self.files.add(filename)
+        self.changed("zap_entire_file", filename)
+
+    def zap_entire_file_end(self, filename):
+        self.file_suffixes.append(filename)
+        self.changed("zap_entire_file_end", filename)
+
+    def zap_line_in_file(self, filename, match):
+        lines = self.exact.setdefault(filename, set())
+        lines.add("+" + match)
+        lines.add("-" + match)
+        self.changed("zap_line_in_file", filename, match)
+
+    def zap_line_in_file_start(self, filename, match):
+        self.prefixes.setdefault(filename, list()).append(match)
+        self.changed("zap_line_in_file_start", filename, match)
+
+    def zap_line_in_file_substring(self, filename, match):
+        self.substrings.setdefault(filename, list()).append(match)
+        self.changed("zap_line_in_file_substring", filename, match)
+
+    def zap_plus_line_in_file(self, filename):
+        self.plus.add(filename)
+        self.changed("zap_plus_line_in_file", filename)
+
+    def compile(self, sources=None):
+        # Build the prefix and substring matcher of every suffix up front.
+        # sources maps (kind, suffix) to trie_regex() output from an
+        # earlier compile, see pattern_sources().
+        if sources is None:
+            sources = dict()
+        self.patterns = dict()
+        for kind, table in (("prefix", self.prefixes), ("substring", self.substrings)):
+            for suffix, matches in table.items():
+                source = sources.get((kind, suffix))
+                if source is None:
+                    source = trie_regex(matches)
+                self.patterns[(kind, suffix)] = re.compile(source, re.DOTALL)
+
+    def pattern_sources(self):
+        if self.patterns is None:
+            self.compile()
+        return {key: pattern.pattern for key, pattern in self.patterns.items()}
+
+    def digest(self):
+        # Identifies the rule set, for caching what it produces
+        return hashlib.sha256(json.dumps(self.rules).encode()).hexdigest()
+
+    def matcher(self, kind, table, file):
+        suffixes = [suffix for suffix in table if file.endswith(suffix)]
+        if len(suffixes) == 0:
+            return None
+        if len(suffixes) == 1:
+            return self.patterns[(kind, suffixes[0])]
+        return re.compile(trie_regex([m for suffix in suffixes for m in table[suffix]]), re.DOTALL)
+
+    def for_file(self, file):
+        # Returns None when the whole file is dropped
+        if file in self.compiled:
+            return self.compiled[file]
+        if self.patterns is None:
+            self.compile()
+
+        if file in self.files or file.endswith(tuple(self.file_suffixes)):
+            rules = None
+        else:
+            prefix = self.matcher("prefix", self.prefixes, file)
+            substring = self.matcher("substring", self.substrings, file)
+            drop_plus = any(file.endswith(suffix) for suffix in self.plus)
+            rules = FileRules(self, file, self.exact.get(file, ()), prefix, substring, drop_plus)
+
+        self.compiled[file] = rules
+        return rules
+
+    def rule_of(self, file, name, match=None):
+        # The first rule called name that applies to file (and to match,
+        # for line rules), as a rule file line.  Used for --stats.
+        key = (file, name, match)
+        if key not in self.explained:
+            self.explained[key] = None
+            for rule_name, args in self.rules:
+                if rule_name != name:
+                    continue
+                if name in ("zap_entire_file", "zap_line_in_file"):
+                    applies = file == args[0]
+                else:
+                    applies = file.endswith(args[0])
+                if applies and (match is None or args[1] == match):
+                    self.explained[key] = shlex.join((name,) + args)
+                    break
+        return self.explained[key]
+
+
+# The default rules live next to this script; a package directory may hold
+# a file of the same name with additions and "!" removals.
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "patchfilter_rules")
+PACKAGE_RULES_FILE = "patchfilter_rules"
+
+RULE_ARGS = {
+    "zap_entire_file": 1,
+    "zap_entire_file_end": 1,
+    "zap_line_in_file": 2,
+    "zap_line_in_file_start": 2,
+    "zap_line_in_file_substring": 2,
+    "zap_plus_line_in_file": 1,
+}
+
+# Bump when the cached data or trie_regex() output changes
+RULES_CACHE_VERSION = 1
+OUTPUT_CACHE_VERSION = 2
+OUTPUT_CACHE_ENTRIES = 2000
+OUTPUT_CACHE_MB = 1024
+
+
+def read_rules(filename, rules=None):
+    # Adds the rules of filename to the list of (name, args) tuples in
+    # rules, or removes them for "!" lines, and returns the list
+    if rules is None:
+        rules = list()
+    with open(filename) as rfile:
+        for number, line in enumerate(rfile, 1):
+            try:
+                words = shlex.split(line, comments=True)
+            except ValueError as e:
+                raise ValueError("%s:%d: %s" % (filename, number, e))
+            if len(words) == 0:
+                continue
+            name = words[0].lstrip("!")
+            if RULE_ARGS.get(name) != len(words) - 1:
+                raise ValueError("%s:%d: invalid rule: %s" % (filename, number, line.strip()))
+            rule = (name, tuple(words[1:]))
+            if words[0].startswith("!"):
+                rules = [r for r in rules if r != rule]
+            else:
+                rules.append(rule)
+    return rules
+
+
+def build_rules(rules, sources=None):
+    table = RuleTable()
+    for name, args in rules:
+        getattr(table, name)(*args)
+    table.compile(sources)
+    return table
+
+
+def rules_cache_dir():
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache, "patchfilter")
+
+
+def file_digest(filename):
+    with open(filename, "rb") as dfile:
+        return hashlib.sha256(dfile.read()).hexdigest()
+
+
+def load_rules(rules_file=RULES_FILE, package_rules_file=None, cache_dir=None):
+    # Returns the RuleTable for rules_file plus the package's overrides.
+    # The parsed rules and the compiled matcher sources are cached on disk,
+    # keyed by the rule files' paths; the cache is used when their mtimes
+    # and sizes are unchanged, or failing that when their hashes match.
+    # A package_rules_file that is rules_file itself, as when running in
+    # projects/common, is skipped rather than adding every rule twice.
+    sources = [os.path.abspath(rules_file)]
+    if (package_rules_file is not None and os.path.exists(package_rules_file)
+            and not os.path.samefile(package_rules_file, rules_file)):
+        sources.append(os.path.abspath(package_rules_file))
+    if cache_dir is None:
+        cache_dir = rules_cache_dir()
+
+    stamps = list()
+    for source in sources:
+        st = os.stat(source)
+        stamps.append((st.st_mtime_ns, st.st_size))
+    key = hashlib.sha256("\0".join([str(RULES_CACHE_VERSION)] + sources).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, key[:32])
+
+    digests = None
+    try:
+        with open(cache_file, "rb") as cfile:
+            cached = pickle.load(cfile)
+        if cached["stamps"] == stamps:
+            return build_rules(cached["rules"], cached["sources"])
+        digests = [file_digest(source) for source in sources]
+        if cached["digests"] == digests:
+            table = build_rules(cached["rules"], cached["sources"])
+            save_rules_cache(cache_file, stamps, digests, cached["rules"], table)
+            return table
+    except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+        pass
+
+    rules = None
+    for source in sources:
+        rules = read_rules(source, rules)
+    table = build_rules(rules)
+    if digests is None:
+        digests = [file_digest(source) for source in sources]
+    save_rules_cache(cache_file, stamps, digests, rules, table)
+    return table
+
+
+def save_rules_cache(cache_file, stamps, digests, rules, table):
+    # Best effort: a read-only or missing cache only costs startup time
+    cached = {"stamps": stamps, "digests": digests, "rules": rules,
+              "sources": table.pattern_sources()}
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(cache_file), delete=False) as cfile:
+            pickle.dump(cached, cfile)
+        os.replace(cfile.name, cache_file)
+    except OSError:
+        pass
+
+
+def head_commit(cwd=None):
+    result = subprocess.run(["git", "rev-parse", "--verify", "-q", "HEAD"], cwd=cwd,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, result.args)
+    return result.stdout.strip()
+
+
+class OutputCache:
+    # Filtered output by commit and rule set, so rerunning on a commit
+    # that has been filtered before (autospec retries, batch sweeps over
+    # unchanged packages) is a file copy.  Entries are plain files named
+    # by key; a hit refreshes the entry's mtime and a store evicts the
+    # least recently used entries until at most max_entries of them,
+    # together at most max_mb, are left.  Like the rules cache, every
+    # OSError just means a miss.
+    def __init__(self, cache_dir=None, max_entries=OUTPUT_CACHE_ENTRIES, max_mb=OUTPUT_CACHE_MB):
+        if cache_dir is None:
+            cache_dir = os.path.join(rules_cache_dir(), "for-review")
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_mb * 1024 * 1024
+
+    def key(self, commit, rules, git_objects):
+        source = "git-objects" if git_objects else "format-patch"
+        parts = [str(OUTPUT_CACHE_VERSION), commit, rules.digest(), source]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def open(self, key):
+        # The entry for key as an open text file, or None
+        path = os.path.join(self.cache_dir, key)
+        try:
+            cfile = open(path, encoding="utf-8", errors="surrogateescape", newline="")
+            os.utime(path)
+        except OSError:
+            return None
+        return cfile
+
+    def create(self):
+        # A temporary file in the cache directory to write an entry to,
+        # for store() to rename into place
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return tempfile.NamedTemporaryFile("w+", dir=self.cache_dir, prefix=".", delete=False,
+                                           encoding="utf-8", errors="surrogateescape", newline="")
+
+    def store(self, filename, key):
+        try:
+            os.replace(filename, os.path.join(self.cache_dir, key))
+            self.evict()
+        except OSError:
+            discard(filename)
+
+    def evict(self):
+        entries = list()
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for n, (_, size, path) in enumerate(entries):
+            if len(entries) - n <= self.max_entries and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def discard(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def write_filtered(rules, git_objects, out, cache=None, stats=None, cwd=None):
+    # Write the filtered latest commit of the repo at cwd to out, one
+    # section at a time.  With a cache, a hit is copied from the cache; a
+    # miss is written to a temporary file in the cache, copied to out and
+    # renamed into the cache, so the output is never all in memory.
+    key = None
+    cfile = None
+    if cache is not None:
+        key = cache.key(head_commit(cwd), rules, git_objects)
+        cached = cache.open(key)
+        if cached is not None:
+            with cached:
+                shutil.copyfileobj(cached, out)
+            return
+        try:
+            cfile = cache.create()
+        except OSError:
+            pass
+
+    if cfile is not None:
+        # nothing has gone to out yet, so a full or broken cache can fall
+        # back to filtering straight to out
+        try:
+            with cfile:
+                sections = parse_patch(patch_lines(rules, git_objects, cwd=cwd))
+                write_patch(filter_patch(sections, rules, stats), cfile)
+        except OSError:
+            discard(cfile.name)
+            cfile = None
+        except BaseException:
+            # evict() never looks at the dot files, so nothing else would
+            discard(cfile.name)
+            raise
+    if cfile is None:
+        sections = parse_patch(patch_lines(rules, git_objects, cwd=cwd))
+        write_patch(filter_patch(sections, rules, stats), out)
+        return
+
+    try:
+        with open(cfile.name, encoding="utf-8", errors="surrogateescape", newline="") as cached:
+            shutil.copyfileobj(cached, out)
+    except BaseException:
+        discard(cfile.name)
+        raise
+    cache.store(cfile.name, key)
 
 
 def chunk_empty(chunk):
@@ -181,225 +715,520 @@ def chunk_empty(chunk):
         if len(line) > 0 and line[0] == '+':
             return False
     return True
-                           
-def zap_empty_chunks():
-    global header
-    global files
-    global files_chunks
-    global files_header
-    files_to_remove = list()
-    for file in files:
-        if file not in files_chunks:
-            files_to_remove.append(file)
+
+
+def filter_patch(sections, rules, stats=None):
+    # Every chunk line is classified once against the rules compiled for
+    # its file; empty chunks and files are dropped on the way.
+    for section in sections:
+        if stats is not None:
+            stats.section_in(section)
+        if section.file is None:
+            if stats is not None:
+                stats.section_out(section)
+            yield section
+            continue
+        file_rules = rules.for_file(section.file)
+        if file_rules is None:
+            if stats is not None:
+                stats.file_dropped(rules, section.file)
             continue
-        to_remove = list()
-        for chunk in files_chunks[file]:
-            if chunk_empty(chunk):
-                to_remove.append(chunk)
-        for c in to_remove:
-            files_chunks[file].remove(c)
-        if len(files_chunks[file]) == 0:
-            files_to_remove.append(file)
-            
-    for file in files_to_remove:
-        files.remove(file)
-            
-            
+        chunks = list()
+        for chunk in section.chunks:
+            if stats is None:
+                chunk = file_rules.filter_chunk(chunk)
+            else:
+                chunk = stats.filter_chunk(file_rules, chunk)
+            if not chunk_empty(chunk):
+                chunks.append(chunk)
+            elif stats is not None:
+                stats.data["empty_chunks"] += 1
+        if len(chunks) > 0:
+            section.chunks = chunks
+            if stats is not None:
+                stats.section_out(section)
+            yield section
+        elif stats is not None:
+            stats.data["files_emptied"] += 1
+
+
+class FilterStats:
+    # Counters for --stats.  data is plain JSON: counts and seconds, rule
+    # hits keyed by rule file line (lines dropped, or files for the
+    # zap_entire_file* rules), and time spent in each kind of matcher.
+    # merge_stats() adds these up across runs.
+    def __init__(self, rules):
+        self.data = {
+            "patches": 1,
+            "seconds": 0.0,
+            "files_in": 0,
+            "files_out": 0,
+            "files_emptied": 0,
+            "lines_in": 0,
+            "lines_out": 0,
+            "chunks_in": 0,
+            "empty_chunks": 0,
+            "rule_hits": {shlex.join((name,) + args): 0 for name, args in rules.rules},
+            "matcher_seconds": {name: 0.0 for name in ("zap_line_in_file", "zap_line_in_file_start",
+                                                       "zap_line_in_file_substring")},
+        }
+
+    def section_lines(self, section):
+        if section.file is None:
+            return len(section.header)
+        return len(section.header) + sum(len(chunk) for chunk in section.chunks)
+
+    def section_in(self, section):
+        self.data["lines_in"] += self.section_lines(section)
+        if section.file is not None:
+            self.data["files_in"] += 1
+            self.data["chunks_in"] += len(section.chunks)
+
+    def section_out(self, section):
+        self.data["lines_out"] += self.section_lines(section)
+        if section.file is not None:
+            self.data["files_out"] += 1
+
+    def hit(self, rule):
+        hits = self.data["rule_hits"]
+        hits[rule] = hits.get(rule, 0) + 1
+
+    def file_dropped(self, rules, file):
+        rule = rules.rule_of(file, "zap_entire_file") or rules.rule_of(file, "zap_entire_file_end")
+        self.hit(rule)
+
+    def filter_chunk(self, file_rules, chunk):
+        kept = list()
+        for line in chunk:
+            rule = file_rules.explain(line, self.data["matcher_seconds"])
+            if rule is None:
+                kept.append(line)
+            else:
+                self.hit(rule)
+        return kept
+
+
+def merge_stats(runs):
+    # Sum FilterStats data from many runs, e.g. a whole batch sweep
+    merged = dict()
+    for run in runs:
+        for key, value in run.items():
+            if isinstance(value, dict):
+                merged[key] = merge_stats([merged.get(key, dict()), value])
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def write_stats(data, target):
+    # "-" prints the data to stderr; anything else is a file that gets one
+    # JSON line per run appended, for --merge-stats
+    if target == "-":
+        json.dump(data, sys.stderr, indent=1)
+        sys.stderr.write("\n")
+    else:
+        with open(target, "a") as sfile:
+            sfile.write(json.dumps(data) + "\n")
+
+
+def read_stats(filenames):
+    runs = list()
+    for filename in filenames:
+        with open(filename) as sfile:
+            for line in sfile:
+                if line.strip():
+                    runs.append(json.loads(line))
+    return runs
+
+
+class Hunk:
+    # A chunk of a FileDiff.  Its lines live in the PatchSet buffer; the
+    # hunk only keeps the numbers of the lines that are still part of it,
+    # and how many of those are "+" lines so emptiness is a lookup.
+    __slots__ = ("lines", "plus")
+
+    def __init__(self, lines, plus):
+        self.lines = lines
+        self.plus = plus
+
+
+class FileDiff:
+    __slots__ = ("name", "header", "hunks")
+
+    def __init__(self, name, header, hunks):
+        self.name = name
+        self.header = header	# line numbers, like Hunk.lines
+        self.hunks = hunks
+
+
+class PatchSet:
+    # A whole parsed patch.  The file header and hunk lines of every file
+    # are stored once, in one string, and addressed by line number through
+    # the starts offsets, so a patch costs a few bytes per line instead of
+    # one str object per line.  Patches are independent of each other and
+    # of any RuleTable, so one process can filter any number of them.
+    #
+    # The rules themselves are only in FileRules: the zap_* methods
+    # compile a one-rule RuleTable and drop the line numbers its drops()
+    # matches, the same test filter_patch() makes on each line.
+    #
+    # Dropped files leave a None tombstone in files, so dropping is O(1)
+    # and positions stay valid; index maps a file name to its positions,
+    # so rules for one exact file name never scan the others.
+    __slots__ = ("header", "files", "index", "text", "starts")
+
+    def __init__(self):
+        self.header = list()
+        self.files = list()
+        self.index = dict()
+        self.text = ""
+        self.starts = array.array("Q", [0])
+
+    @classmethod
+    def from_sections(cls, sections):
+        patch = cls()
+        pieces = list()
+        pos = 0
+        starts = patch.starts
+
+        def store(lines):
+            nonlocal pos
+            first = len(starts) - 1
+            for line in lines:
+                pos += len(line) + 1
+                starts.append(pos)
+            if len(lines) > 0:
+                pieces.append("\n".join(lines) + "\n")
+            return array.array("I", range(first, len(starts) - 1))
+
+        for section in sections:
+            if section.file is None:
+                patch.header = section.header
+                continue
+            hunks = list()
+            for chunk in section.chunks:
+                plus = sum(1 for line in chunk if line[:1] == "+")
+                hunks.append(Hunk(store(chunk), plus))
+            patch.add_file(FileDiff(section.file, store(section.header), hunks))
+
+        patch.text = "".join(pieces)
+        return patch
+
+    @classmethod
+    def parse(cls, lines):
+        return cls.from_sections(parse_patch(lines))
+
+    def add_file(self, file):
+        self.index.setdefault(file.name, list()).append(len(self.files))
+        self.files.append(file)
+
+    def copy(self):
+        # Shares the line buffer, copies the line number arrays
+        patch = PatchSet()
+        patch.header = self.header
+        patch.text = self.text
+        patch.starts = self.starts
+        for file in self.live_files():
+            hunks = [Hunk(hunk.lines[:], hunk.plus) for hunk in file.hunks]
+            patch.add_file(FileDiff(file.name, file.header, hunks))
+        return patch
+
+    def live_files(self):
+        for file in self.files:
+            if file is not None:
+                yield file
+
+    def positions(self, filename):
+        # Positions of the live files called filename
+        return [n for n in self.index.get(filename, ()) if self.files[n] is not None]
+
+    def drop_file(self, position):
+        self.files[position] = None
+
+    def line(self, number):
+        return self.text[self.starts[number]:self.starts[number + 1] - 1]
+
+    def sections(self):
+        line = self.line
+        section = Section(None)
+        section.header = list(self.header)
+        yield section
+        for file in self.live_files():
+            section = Section(file.name)
+            section.header = [line(n) for n in file.header]
+            section.chunks = [[line(n) for n in hunk.lines] for hunk in file.hunks]
+            yield section
+
+    def write(self, out):
+        write_patch(self.sections(), out)
+
+    def apply(self, rules, positions=None):
+        # Apply a RuleTable without dropping the chunks and files it
+        # empties.  positions limits it to the files at those positions.
+        if positions is None:
+            positions = range(len(self.files))
+        for n in positions:
+            file = self.files[n]
+            if file is None:
+                continue
+            file_rules = rules.for_file(file.name)
+            if file_rules is None:
+                self.drop_file(n)
+            elif not file_rules.empty:
+                self.filter_hunks(file, file_rules.drops)
+
+    def filter_hunks(self, file, drops):
+        text = self.text
+        starts = self.starts
+        line = self.line
+        for hunk in file.hunks:
+            lines = array.array("I", [n for n in hunk.lines if not drops(line(n))])
+            if len(lines) != len(hunk.lines):
+                hunk.lines = lines
+                hunk.plus = sum(1 for n in lines if text[starts[n]] == "+")
+
+    def filter(self, rules, stats=None):
+        if stats is None:
+            self.apply(rules)
+            self.zap_empty_chunks()
+            return
+        # the counters are kept by filter_patch(), so go through it once
+        patch = PatchSet.from_sections(filter_patch(self.sections(), rules, stats))
+        self.header = patch.header
+        self.files = patch.files
+        self.index = patch.index
+        self.text = patch.text
+        self.starts = patch.starts
+
+    def hunk_empty(self, hunk):
+        return hunk.plus == 0
+
+    def zap_empty_chunks(self):
+        for n, file in enumerate(self.files):
+            if file is None:
+                continue
+            file.hunks = [hunk for hunk in file.hunks if hunk.plus > 0]
+            if len(file.hunks) == 0:
+                self.drop_file(n)
+
+    def zap(self, name, *args, positions=None):
+        # Apply a single rule
+        rules = RuleTable()
+        getattr(rules, name)(*args)
+        self.apply(rules, positions)
+
+    def zap_entire_file(self, filename):
+        for n in self.positions(filename):
+            self.drop_file(n)
+
+    def zap_entire_file_end(self, filename):
+        self.zap("zap_entire_file_end", filename)
+
+    def zap_line_in_file(self, filename, match):
+        self.zap("zap_line_in_file", filename, match, positions=self.positions(filename))
+
+    def zap_line_in_file_start(self, filename, match):
+        self.zap("zap_line_in_file_start", filename, match)
+
+    def zap_line_in_file_substring(self, filename, match):
+        self.zap("zap_line_in_file_substring", filename, match)
+
+    def zap_plus_line_in_file(self, filename):
+        self.zap("zap_plus_line_in_file", filename)
+
+
+def package_directory(paths=()):
+    # Where the package's rule overrides live: next to the patch file
+    # being filtered, or the top of the git repo filtered otherwise
+    if len(paths) > 0:
+        return os.path.dirname(os.path.abspath(paths[0]))
+    result = subprocess.run(["git", "rev-parse", "--show-toplevel"], stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, universal_newlines=True)
+    if result.returncode != 0:
+        return os.getcwd()
+    return result.stdout.strip()
+
+
+def default_rules(package_dir="."):
+    return load_rules(package_rules_file=os.path.join(package_dir, PACKAGE_RULES_FILE))
+
+
+# Set up once per batch worker process
+batch_rules_file = RULES_FILE
+batch_rules = None
+batch_git_objects = False
+batch_stats = False
+batch_cache = None
+
+
+def init_batch_worker(rules_file, git_objects, stats, cache):
+    global batch_rules_file
+    global batch_rules
+    global batch_git_objects
+    global batch_stats
+    global batch_cache
+    batch_rules_file = rules_file
+    batch_rules = load_rules(rules_file)
+    batch_git_objects = git_objects
+    batch_stats = stats
+    batch_cache = cache
+
+
+def patch_lines(rules, git_objects, cwd=None):
+    if git_objects:
+        return commit_lines(rules, cwd=cwd)
+    return format_patch_lines(cwd=cwd)
+
+
+def review_package(path):
+    # Batch worker: write path/for-review.txt from the package's latest
+    # commit.  Returns (path, error, seconds, stats data or None).
+    start = time.monotonic()
+    stats = None
+    outfile = os.path.join(path, "for-review.txt")
+    try:
+        rules = batch_rules
+        package_rules_file = os.path.join(path, PACKAGE_RULES_FILE)
+        if os.path.exists(package_rules_file):
+            rules = load_rules(batch_rules_file, package_rules_file)
+        cache = batch_cache
+        if batch_stats:
+            # stats are about filtering, so a cached result won't do
+            stats = FilterStats(rules)
+            cache = None
+        with open(outfile + ".tmp", "w", errors="surrogateescape", newline="") as out:
+            write_filtered(rules, batch_git_objects, out, cache, stats, cwd=path)
+        os.replace(outfile + ".tmp", outfile)
+    except (OSError, KeyError, ValueError, subprocess.CalledProcessError) as e:
+        if os.path.exists(outfile + ".tmp"):
+            os.remove(outfile + ".tmp")
+        return path, str(e), time.monotonic() - start, None
+    seconds = time.monotonic() - start
+    if stats is not None:
+        stats.data["seconds"] = seconds
+        stats = stats.data
+    return path, None, seconds, stats
+
+
+def read_packages(filename, packages_dir):
+    # Package names from a projects/common/packages style file, as paths
+    # of the ones that are checked out
+    paths = list()
+    with open(filename) as pfile:
+        for line in pfile:
+            name = line.strip()
+            path = os.path.join(packages_dir, name)
+            if name and os.path.isdir(os.path.join(path, ".git")):
+                paths.append(path)
+    return paths
+
+
+def batch(paths, jobs, rules_file, git_objects, stats_target=None, cache=None):
+    start = time.monotonic()
+    failed = list()
+    timings = list()
+    runs = list()
+    jobs = max(1, min(jobs, len(paths)))
+    initargs = (rules_file, git_objects, stats_target is not None, cache)
+    with multiprocessing.Pool(jobs, initializer=init_batch_worker, initargs=initargs) as pool:
+        for path, error, seconds, stats in pool.imap_unordered(review_package, paths, chunksize=4):
+            timings.append((seconds, path))
+            if stats is not None:
+                runs.append(stats)
+            if error is not None:
+                failed.append(path)
+                print(f"{path}: {error}", file=sys.stderr)
+            if len(timings) % 100 == 0:
+                print(f"{len(timings)}/{len(paths)} packages", file=sys.stderr)
+    elapsed = time.monotonic() - start
+
+    print(f"Filtered {len(paths) - len(failed)}/{len(paths)} packages in {elapsed:.1f}s with {jobs} jobs")
+    if len(timings) > 0:
+        busy = sum(seconds for seconds, _ in timings)
+        print(f"Average {busy / len(timings):.3f}s per package, slowest:")
+        for seconds, path in sorted(timings, reverse=True)[:5]:
+            print(f"  {seconds:.3f}s {path}")
+    for path in failed:
+        print(f"FAILED: {path}")
+    if stats_target is not None and len(runs) > 0:
+        write_stats(merge_stats(runs), stats_target)
+    return len(failed) == 0
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Filter autospec noise out of a package commit for review.")
+    parser.add_argument("paths", nargs="*", metavar="PATH",
+                        help="patch file to filter (default: git format-patch -1 in the current repo), "
+                        "or package directories with --batch")
+    parser.add_argument("--batch", action="store_true",
+                        help="write for-review.txt in each package directory from its latest commit")
+    parser.add_argument("--packages", metavar="FILE",
+                        help="with --batch, also take the packages listed in FILE")
+    parser.add_argument("--packages-dir", metavar="DIR",
+                        help="where the --packages packages are checked out (default: ../../packages from FILE)")
+    parser.add_argument("--rules", metavar="FILE", default=RULES_FILE,
+                        help="rule file to use (default: %(default)s); a patchfilter_rules file "
+                        "in the package directory adds to it")
+    parser.add_argument("--git-objects", action="store_true",
+                        help="leave the files the rules drop entirely out of the diff instead of "
+                        "filtering them, using the git object database (no diffstat or signature)")
+    parser.add_argument("--stats", nargs="?", const="-", metavar="FILE",
+                        help="print rule hit counts, matcher timings and line/file counts as JSON "
+                        "on stderr, or append them to FILE as one JSON line (summed over --batch)")
+    parser.add_argument("--merge-stats", nargs="+", metavar="FILE",
+                        help="sum the --stats runs recorded in FILE... and print them as JSON")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="where filtered commits are cached by commit and rule set "
+                        "(default: ~/.cache/patchfilter/for-review)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always filter the commit, don't read or write the cache")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of batch worker processes")
+    args = parser.parse_args()
+    if not args.batch and (len(args.paths) > 1 or args.packages):
+        parser.error("--packages and more than one PATH need --batch")
+    return args
 
 
 def main():
+    args = get_args()
 
-    if len(sys.argv) > 1:
-        filename = sys.argv[1]
-    
-        with open (filename, "r") as myfile:
-            lines = myfile.readlines()
+    if args.merge_stats:
+        merged = merge_stats(read_stats(args.merge_stats))
+        if "rule_hits" in merged:
+            merged["rule_hits"] = dict(sorted(merged["rule_hits"].items(), key=lambda hit: -hit[1]))
+        json.dump(merged, sys.stdout, indent=1)
+        print()
+        return
+
+    cache = None
+    if not args.no_cache:
+        cache = OutputCache(args.cache_dir)
+
+    if args.batch:
+        paths = list(args.paths)
+        if args.packages:
+            packages_dir = args.packages_dir
+            if packages_dir is None:
+                packages_dir = os.path.join(os.path.dirname(os.path.abspath(args.packages)), "../../packages")
+            paths.extend(read_packages(args.packages, packages_dir))
+        sys.exit(0 if batch(paths, args.jobs, args.rules, args.git_objects, args.stats, cache) else 1)
+
+    rules = load_rules(args.rules, os.path.join(package_directory(args.paths), PACKAGE_RULES_FILE))
+    stats = None
+    if args.stats:
+        stats = FilterStats(rules)
+        cache = None
+    start = time.monotonic()
+    if len(args.paths) > 0:
+        sections = parse_patch(file_lines(args.paths[0]))
+        write_patch(filter_patch(sections, rules, stats), sys.stdout)
     else:
-        output = subprocess.check_output("git format-patch -1 --stdout", shell=True).decode("utf-8", errors="replace")
-        lines = output.split("\n")
-        
-    parse_patch(lines)
-
-    zap_entire_file("b/release")
-    zap_entire_file("b/buildreq_cache")
-    zap_entire_file("b/.gitignore")
-    zap_entire_file("b/upstream")
-    zap_entire_file("b/NEWS")
-    zap_entire_file("b/ChangeLog")
-    zap_entire_file_end("xz.sig")
-    zap_entire_file_end("gz.sig")
-    zap_entire_file_end("bz2.sig")
-    zap_entire_file_end("xz.asc")
-    zap_entire_file_end("gz.asc")
-    zap_entire_file_end("bz2.asc")
-    
-    zap_entire_file_end(".pkey")
-    
-    zap_line_in_file("b/testresults", "Total : 0")
-    zap_line_in_file("b/testresults", "Pass : 0")
-    zap_line_in_file("b/testresults", "Fail : 0")
-    zap_line_in_file("b/testresults", "XFail : 0")
-    zap_line_in_file("b/testresults", "Skip : 0")
-    
-    zap_line_in_file("b/requires_ban", "#FOO")
-    zap_line_in_file("b/Makefile", "ARCHIVES = ")
-    zap_line_in_file("b/Makefile", "include ../common/Makefile.common")
-    zap_line_in_file("b/Makefile", "")
-    
-    zap_line_in_file_start(".spec", "Release  :")
-    zap_line_in_file_start(".spec", "Source99 :")
-    zap_line_in_file_start(".spec", "export SOURCE_DATE_EPOCH")
-    zap_line_in_file_start(".spec", "export AR=gcc-ar")
-    zap_line_in_file_start(".spec", "export RANLIB=gcc-ranlib")
-    zap_line_in_file_start(".spec", "export NM=gcc-nm")
-    zap_line_in_file_start(".spec", "export CFLAGS=\"$CFLAGS -O3 -ffat-lto-objects -flto=4 \"")
-    zap_line_in_file_start(".spec", "export FCFLAGS=\"$CFLAGS -O3 -ffat-lto-objects -flto=4 \"")
-    zap_line_in_file_start(".spec", "export FCFLAGS=\"$FFLAGS -O3 -ffat-lto-objects -flto=4 \"")
-    zap_line_in_file_start(".spec", "export FFLAGS=\"$CFLAGS -O3 -ffat-lto-objects -flto=4 \"")
-    zap_line_in_file_start(".spec", "export FFLAGS=\"$FFLAGS -O3 -ffat-lto-objects -flto=4 \"")
-    zap_line_in_file_start(".spec", "export CXXFLAGS=\"$CXXFLAGS -O3 -ffat-lto-objects -flto=4 \"")
-    zap_line_in_file_start(".spec", "%setup -q -n ")
-    zap_line_in_file_start(".spec", "URL      :")
-    zap_line_in_file_start(".spec", "Version  :")
-    zap_line_in_file_start(".spec", "Group    : Development/Tools")
-    zap_line_in_file_start(".spec", "No detailed description available")
-    zap_line_in_file_start(".spec", "bin components for the")
-    zap_line_in_file_start(".spec", "dev components for the")
-    zap_line_in_file_start(".spec", "lib components for the")
-    zap_line_in_file_start(".spec", "data components for the")
-    zap_line_in_file_start(".spec", "locales components for the")
-    zap_line_in_file_start(".spec", "license components for the")
-    zap_line_in_file_start(".spec", "doc components for the")
-    zap_line_in_file_start(".spec", "Group: Default")
-    zap_line_in_file_start(".spec", "export http_proxy=http://127.0.0.1:9/")
-    zap_line_in_file_start(".spec", "export https_proxy=http://127.0.0.1:9/")
-    zap_line_in_file_start(".spec", "export ftp_proxy=http://127.0.0.1:9/")
-    zap_line_in_file_start(".spec", "export no_proxy=localhost,127.0.0.1,0.0.0.0")
-    zap_line_in_file_start(".spec", "Summary:")
-    zap_line_in_file_start(".spec", "Group: Development")
-    zap_line_in_file_start(".spec", "Group: Binaries")
-    zap_line_in_file_start(".spec", "Group: Data")
-    zap_line_in_file_start(".spec", "Group: Libraries")
-    zap_line_in_file_start(".spec", "Group: Documentation")
-    zap_line_in_file_start(".spec", "export LANG=C")
-    zap_line_in_file_start(".spec", "%description lib")
-    zap_line_in_file_start(".spec", "%description bin")
-    zap_line_in_file_start(".spec", "%description data")
-    zap_line_in_file_start(".spec", "%description doc")
-    zap_line_in_file_start(".spec", "%description locales")
-    zap_line_in_file_start(".spec", "%description dev")
-    zap_line_in_file_start(".spec", "%description license")
-    zap_line_in_file_start(".spec", "%package doc")
-    zap_line_in_file_start(".spec", "cp -a ")
-    zap_line_in_file_start(".spec", "cd %{_builddir}/")
-    zap_line_in_file_start(".spec", "export GCC_IGNORE_WERROR=1")
-    zap_line_in_file_start(".spec", "rm -rf %{buildroot}")
- 
-    zap_line_in_file_start("b/Makefile", "URL =")
-    zap_line_in_file_start("b/Makefile", "PKG_NAME :=")
-
-    zap_line_in_file_start("b/options.conf", "name = ")
-    zap_line_in_file("b/options.conf", "archives = ")
-    zap_line_in_file("b/options.conf", "giturl = ")
-    zap_line_in_file_start("b/options.conf", "url = ")
-    zap_line_in_file("b/options.conf", "[package]")
-    zap_line_in_file("b/options.conf", "")
-    zap_line_in_file("b/options.conf", "[autospec]")
-    zap_line_in_file("b/options.conf", "# build 32 bit libraries")
-    zap_line_in_file("b/options.conf", "32bit = false")
-    zap_line_in_file("b/options.conf", "# allow package to build with test failures")
-    zap_line_in_file("b/options.conf", "allow_test_failures = false")
-    zap_line_in_file("b/options.conf", "# unset %build ld_as_needed variable")
-    zap_line_in_file("b/options.conf", "asneeded = false")
-    zap_line_in_file("b/options.conf", "# this package is trusted enough to automatically update (used by other tools)")
-    zap_line_in_file("b/options.conf", "autoupdate = false")
-    zap_line_in_file("b/options.conf", "# extend flags with '-std=gnu++98")
-    zap_line_in_file("b/options.conf", "broken_c++ = false")
-    zap_line_in_file("b/options.conf", "# disable parallelization during build")
-    zap_line_in_file("b/options.conf", "broken_parallel_build = false")
-    zap_line_in_file("b/options.conf", "# this package is a library compatability package and only ships versioned library files")
-    zap_line_in_file("b/options.conf", "# this package is a library compatibility package and only ships versioned library files")
-    zap_line_in_file("b/options.conf", "compat = false")
-    zap_line_in_file("b/options.conf", "# set conservative build flags")
-    zap_line_in_file("b/options.conf", "conservative_flags = false")
-    zap_line_in_file("b/options.conf", "# dev package requires the extras to be installed")
-    zap_line_in_file("b/options.conf", "dev_requires_extras = false")
-    zap_line_in_file("b/options.conf", "nodebug = false")
-    zap_line_in_file("b/options.conf", "# pass -ffast-math to compiler")
-    zap_line_in_file("b/options.conf", "fast-math = false")
-    zap_line_in_file("b/options.conf", "# optimize build for speed over size")
-    zap_line_in_file("b/options.conf", "funroll-loops = false")
-    zap_line_in_file("b/options.conf", "# set flags to smallest -02 flags possible")
-    zap_line_in_file("b/options.conf", "insecure_build = false")
-    zap_line_in_file("b/options.conf", "# do not remove static libraries")
-    zap_line_in_file("b/options.conf", "keepstatic = false")
-    zap_line_in_file("b/options.conf", "# do not require autostart subpackage")
-    zap_line_in_file("b/options.conf", "no_autostart = false")
-    zap_line_in_file("b/options.conf", "# disable stripping binaries")
-    zap_line_in_file("b/options.conf", "nostrip = false")
-    zap_line_in_file("b/options.conf", "# optimize build for size over speed")
-    zap_line_in_file("b/options.conf", "optimize_size = false")
-    zap_line_in_file("b/options.conf", "# set profile for pgo")
-    zap_line_in_file("b/options.conf", "pgo = false")
-    zap_line_in_file("b/options.conf", "# set flags for security-sensitive builds")
-    zap_line_in_file("b/options.conf", "security_sensitive = false")
-    zap_line_in_file("b/options.conf", "# do not run test suite")
-    zap_line_in_file("b/options.conf", "skip_tests = false")
-    zap_line_in_file("b/options.conf", "# add .so files to the lib package instead of dev")
-    zap_line_in_file("b/options.conf", "so_to_lib = false")
-    zap_line_in_file("b/options.conf", "# configure build for avx2")
-    zap_line_in_file("b/options.conf", "use_avx2 = false")
-    zap_line_in_file("b/options.conf", "# configure build for avx512")
-    zap_line_in_file("b/options.conf", "use_avx512 = false")
-    zap_line_in_file("b/options.conf", "# add clang flags")
-    zap_line_in_file("b/options.conf", "use_clang = false")
-    zap_line_in_file("b/options.conf", "# configure build for lto")
-    zap_line_in_file("b/options.conf", "use_lto = true")
-    zap_line_in_file("b/options.conf", "# require package verification for build")
-    zap_line_in_file("b/options.conf", "verify_required = true")
-    zap_line_in_file("b/options.conf", "# do not generate debuginfo for this package")
-    zap_line_in_file("b/options.conf", "# configure build also for openmpi")
-    zap_line_in_file("b/options.conf", "openmpi = false")
-    zap_line_in_file("b/options.conf", "alias =")
-    zap_line_in_file("b/options.conf", "alias = ")
-    zap_line_in_file("b/options.conf", "nodebug = false")
-    zap_line_in_file("b/options.conf", "domain =")
-    zap_line_in_file("b/options.conf", "domain = ")
-
-    zap_line_in_file("b/buildreq_add", "# This file contains additional build requirements that did not get")
-    zap_line_in_file("b/buildreq_add", "# picked up automatically. One name per line, no whitespace.")
-    zap_line_in_file("b/buildreq_ban", "# This file contains build requirements that get picked up but are")
-    zap_line_in_file("b/buildreq_ban", "# undesirable. One entry per line, no whitespace.")
-    
-    
-    zap_line_in_file("b/excludes", "# This file contains the output files that need %exclude. Full path")
-    zap_line_in_file("b/excludes", "# names, one per line.")
-
-    zap_line_in_file("b/pkgconfig_add", "# This file contains additional pkgconfig build requirements that did")
-    zap_line_in_file("b/pkgconfig_add", "# not get picked up automatically. One name per line, no whitespace.")
-    zap_line_in_file("b/pkgconfig_ban", "# This file contains pkgconfig build requirements that get picked up")
-    zap_line_in_file("b/pkgconfig_ban", "# but are undesirable. One entry per line, no whitespace.")
-    zap_line_in_file("b/requires_add", "# This file contains additional runtime requirements that did not get")
-    zap_line_in_file("b/requires_add", "# picked up automatically. One name per line, no whitespace.")
-    zap_line_in_file("b/requires_ban", "# This file contains runtime requirements that get picked up but are")
-    zap_line_in_file("b/requires_ban", "# undesirable. One entry per line, no whitespace.")
-    
-    zap_line_in_file_start(".spec", "Summary  : No detailed summary available")
-    
-    zap_plus_line_in_file("symbols")
-    zap_plus_line_in_file("symbols32")
-
-    zap_entire_file("b/whatrequires")
-    zap_entire_file("b/versions")
-    zap_entire_file("b/.gitignore")
-    
-
-    zap_line_in_file_substring(".spec", "%{buildroot}/usr/share/package-licenses")   # version number change in license copy
-    zap_empty_chunks()
-    
-    print_all()
+        write_filtered(rules, args.git_objects, sys.stdout, cache, stats)
+    if stats is not None:
+        stats.data["seconds"] = time.monotonic() - start
+        write_stats(stats.data, args.stats)
 
 if __name__ == '__main__':
     with tempfile.TemporaryDirectory() as workingdir:
         main()
-
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Reading and editing a package repo's metadata files: the Makefile's
+# URL and ARCHIVES lines, options.conf and files like cargo_vendors.
+#
+# Every edit is one pass over the file, and files are replaced with a
+# rename so a killed job never leaves a half-written Makefile behind.
+# The patterns for a package name are compiled once per process, which
+# matters to the batch modes that edit many packages.
+
+import configparser
+import functools
+import os
+import re
+import tempfile
+
+# Vendor snapshot archives as the package Makefile and options.conf name them
+MAKEFILE_SNAPSHOT = '$(CGIT_BASE_URL)/vendor/{name}/snapshot/{name}'
+OPTIONS_SNAPSHOT = 'http://localhost/cgit/vendor/{name}/snapshot/{name}'
+TAG_PATTERN = r'-([a-zA-Z0-9_\-.]+)\.tar\.gz'
+
+
+def write_file(path, text):
+    # Replace path with text atomically, keeping the file's permissions
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix=f".{os.path.basename(path)}.",
+                                     delete=False, encoding='utf8') as tfile:
+        tfile.write(text)
+    try:
+        os.chmod(tfile.name, os.stat(path).st_mode & 0o7777)
+    except FileNotFoundError:
+        os.chmod(tfile.name, 0o644)
+    os.replace(tfile.name, path)
+
+
+def edit_lines(path, prefix, edit):
+    # Pass every line starting with prefix through edit() and write the
+    # file back if anything changed.  Returns the edited lines.
+    with open(path, encoding='utf8') as efile:
+        lines = efile.readlines()
+    edited = []
+    changed = False
+    for i, line in enumerate(lines):
+        if line.startswith(prefix):
+            new = edit(line)
+            edited.append(new)
+            if new != line:
+                lines[i] = new
+                changed = True
+    if changed:
+        write_file(path, ''.join(lines))
+    return edited
+
+
+@functools.lru_cache(maxsize=None)
+def snapshot_patterns(name):
+    # Compiled patterns for the vendor snapshot URL of package name in
+    # the Makefile and in options.conf; group 1 is the tag
+    return (re.compile(re.escape(MAKEFILE_SNAPSHOT.format(name=name)) + TAG_PATTERN),
+            re.compile(re.escape(OPTIONS_SNAPSHOT.format(name=name)) + TAG_PATTERN))
+
+
+def set_archive(line, pattern, archive):
+    # line with pattern's archive replaced by archive, or with archive
+    # appended (extracted to ./vendor) when it had none
+    if pattern.search(line):
+        return pattern.sub(lambda _: archive, line)
+    line = line.rstrip('\n')
+    return f"{line} {archive} ./vendor\n"
+
+
+def set_vendor_tag(name, tag, path='.'):
+    # Point the package at vendor snapshot tag in both the Makefile and
+    # options.conf.  Returns the Makefile's new ARCHIVES lines.
+    makefile_pattern, options_pattern = snapshot_patterns(name)
+    makefile_archive = f"{MAKEFILE_SNAPSHOT.format(name=name)}-{tag}.tar.gz"
+    options_archive = f"{OPTIONS_SNAPSHOT.format(name=name)}-{tag}.tar.gz"
+    archives = edit_lines(os.path.join(path, 'Makefile'), 'ARCHIVES',
+                          lambda line: set_archive(line, makefile_pattern, makefile_archive))
+    edit_lines(os.path.join(path, 'options.conf'), 'archives',
+               lambda line: set_archive(line, options_pattern, options_archive))
+    return archives
+
+
+def vendor_tag(name, path='.'):
+    # The vendor snapshot tag the package's Makefile points at, or None
+    makefile_pattern = snapshot_patterns(name)[0]
+    try:
+        with open(os.path.join(path, 'Makefile'), encoding='utf8') as mfile:
+            for line in mfile:
+                if line.startswith('ARCHIVES') and (m := makefile_pattern.search(line)):
+                    return m.group(1)
+    except OSError:
+        pass
+    return None
+
+
+def read_options(path='.'):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.join(path, 'options.conf'))
+    return config
+
+
+def package_url(path='.'):
+    # The package's upstream URL, from options.conf or else the Makefile
+    if url := read_options(path).get('package', 'url', fallback=None):
+        return url
+    with open(os.path.join(path, 'Makefile'), encoding='utf8') as mfile:
+        for line in mfile:
+            if line.startswith('URL'):
+                return line.split('=', 1)[1].split()[0]
+    return None
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# Shared on-disk cache of upstream source archives.
+#
+# Archives are stored once, by sha256, under objects/; urls/ maps each URL
+# to the archive it last returned, with the server's ETag/Last-Modified
+# and when it was last used.  Files go in and out of the cache as copies,
+# never hard links, so a tool rewriting its file in place can't change
+# the cached archive, and get checks an archive's sha256 as it copies it
+# out.  When the cache grows past its size cap the least recently used
+# archives are removed.
+#
+# Used by vendor.py, and by the sources/generateupstream targets through
+# the get/put commands:
+#
+#   sourcecache.py get URL FILE    exit 1 if URL isn't cached, else write FILE
+#   sourcecache.py put URL FILE    add FILE, downloaded from URL, to the cache
+#   sourcecache.py fetch URL FILE  get, downloading on a miss
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+DEFAULT_MAX_MB = 20480
+
+
+def default_cache_dir():
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache, 'clear-sources')
+
+
+def url_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def read_entry(cache_dir, url):
+    # The urls/ entry for url, or None when url isn't cached
+    try:
+        with open(os.path.join(cache_dir, 'urls', url_key(url)), encoding='utf8') as efile:
+            entry = json.load(efile)
+    except (OSError, ValueError):
+        return None
+    if entry.get('url') != url or not os.path.isfile(object_path(cache_dir, entry['sha256'])):
+        return None
+    return entry
+
+
+def write_entry(cache_dir, entry):
+    write_atomic(os.path.join(cache_dir, 'urls', url_key(entry['url'])),
+                 json.dumps(entry).encode())
+
+
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), prefix='.', delete=False) as tfile:
+        tfile.write(data)
+    os.replace(tfile.name, path)
+
+
+def object_path(cache_dir, sha256):
+    return os.path.join(cache_dir, 'objects', sha256[:2], sha256)
+
+
+def copy_file(src, dst):
+    # Copy src to dst and return the sha256 of the copy.  dst is replaced
+    # by rename rather than written to, so whatever dst was linked to
+    # stays as it was.
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(os.path.abspath(dst)), prefix='.',
+                                     delete=False) as tfile:
+        try:
+            with open(src, 'rb') as sfile:
+                while chunk := sfile.read(1 << 20):
+                    digest.update(chunk)
+                    tfile.write(chunk)
+        except BaseException:
+            os.remove(tfile.name)
+            raise
+    os.chmod(tfile.name, 0o644)
+    os.replace(tfile.name, dst)
+    return digest.hexdigest()
+
+
+def get(url, outfile, cache_dir):
+    # Write the cached archive for url to outfile without touching the
+    # network.  Returns False when url isn't cached, or when the cached
+    # archive no longer matches its sha256, which drops it.
+    entry = read_entry(cache_dir, url)
+    if entry is None:
+        return False
+    path = object_path(cache_dir, entry['sha256'])
+    if copy_file(path, outfile) != entry['sha256']:
+        os.remove(outfile)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return False
+    entry['used'] = time.time()
+    try:
+        write_entry(cache_dir, entry)
+    except OSError:
+        pass
+    return True
+
+
+def put(url, infile, cache_dir, max_mb=DEFAULT_MAX_MB, headers=None):
+    # Add infile, as downloaded from url, to the cache and return its
+    # sha256.  headers are the response headers, for revalidation.
+    objects = os.path.join(cache_dir, 'objects')
+    os.makedirs(objects, exist_ok=True)
+    tmp = os.path.join(objects, f".put-{os.getpid()}-{time.monotonic_ns()}")
+    try:
+        sha256 = copy_file(infile, tmp)
+        path = object_path(cache_dir, sha256)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    headers = headers or {}
+    write_entry(cache_dir, {
+        'url': url,
+        'sha256': sha256,
+        'size': os.path.getsize(path),
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'used': time.time(),
+    })
+    evict(cache_dir, max_mb)
+    return sha256
+
+
+def fetch(url, outfile, cache_dir, max_mb=DEFAULT_MAX_MB, timeout=30):
+    # Write url to outfile, from the cache when it has the archive, and
+    # return the number of bytes downloaded.  A cached entry with an ETag
+    # or Last-Modified is revalidated with a conditional request; entries
+    # without (as added by put) are assumed to be immutable, like the
+    # versioned release URLs they usually are.
+    import requests  # only needed here, get and put run without it
+
+    entry = read_entry(cache_dir, url)
+    request_headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            request_headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            request_headers['If-Modified-Since'] = entry['last_modified']
+        if not request_headers and get(url, outfile, cache_dir):
+            return 0
+
+    downloaded = 0
+    with requests.get(url, timeout=timeout, stream=True, headers=request_headers) as response:
+        if response.status_code == 304:
+            if get(url, outfile, cache_dir):
+                return 0
+            # the cached archive went bad and was dropped, fetch it again
+            return fetch(url, outfile, cache_dir, max_mb, timeout)
+        response.raise_for_status()
+        # written aside and renamed, like copy_file()
+        with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(os.path.abspath(outfile)), prefix='.',
+                                         delete=False) as ofile:
+            try:
+                for chunk in response.iter_content(1 << 20):
+                    ofile.write(chunk)
+                    downloaded += len(chunk)
+            except BaseException:
+                os.remove(ofile.name)
+                raise
+        os.chmod(ofile.name, 0o644)
+        os.replace(ofile.name, outfile)
+        response_headers = response.headers
+    try:
+        put(url, outfile, cache_dir, max_mb, response_headers)
+    except OSError:
+        # a full or read-only cache must not fail the download
+        pass
+    return downloaded
+
+
+def evict(cache_dir, max_mb):
+    # Remove the least recently used archives until the cache fits in
+    # max_mb, along with the urls/ entries pointing at them
+    entries = []
+    urls = os.path.join(cache_dir, 'urls')
+    for name in os.listdir(urls):
+        if name.startswith('.'):
+            continue
+        try:
+            with open(os.path.join(urls, name), encoding='utf8') as efile:
+                entries.append((name, json.load(efile)))
+        except (OSError, ValueError):
+            continue
+
+    objects = {}
+    for name, entry in entries:
+        sha256 = entry['sha256']
+        used = max(entry.get('used', 0), objects.get(sha256, (0, 0))[0])
+        objects[sha256] = (used, entry.get('size', 0))
+
+    total = sum(size for _, size in objects.values())
+    limit = max_mb * 1024 * 1024
+    removed = set()
+    for sha256, (_, size) in sorted(objects.items(), key=lambda item: item[1][0]):
+        if total <= limit:
+            break
+        try:
+            os.remove(object_path(cache_dir, sha256))
+        except FileNotFoundError:
+            pass
+        removed.add(sha256)
+        total -= size
+
+    for name, entry in entries:
+        if entry['sha256'] in removed:
+            try:
+                os.remove(os.path.join(urls, name))
+            except FileNotFoundError:
+                pass
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Shared cache of upstream source archives.')
+    parser.add_argument('--cache-dir', default=default_cache_dir(),
+                        help='cache location (default: %(default)s)')
+    parser.add_argument('--max-mb', type=int, default=DEFAULT_MAX_MB,
+                        help='size cap in MB, least recently used archives go first (default: %(default)s)')
+    parser.add_argument('command', choices=('get', 'put', 'fetch'))
+    parser.add_argument('url')
+    parser.add_argument('file')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.command == 'get':
+        found = get(args.url, args.file, args.cache_dir)
+    elif args.command == 'put':
+        found = bool(put(args.url, args.file, args.cache_dir, args.max_mb))
+    else:
+        fetch(args.url, args.file, args.cache_dir, args.max_mb)
+        found = True
+    sys.exit(0 if found else 1)
+
+
+if __name__ == '__main__':
+    main()
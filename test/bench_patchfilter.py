@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# Benchmark for patchfilter.py.
+#
+# Filters the golden corpus in test/patchfilter plus synthetic patches
+# shaped like the big autospec commits (huge symbols diffs, vendored
+# trees, spec rewrites) and reports throughput, peak RSS of a separate
+# patchfilter.py process, and the cost of each rule on its own.  Corpus
+# output is checked against the .golden files; a mismatch fails the run.
+import argparse
+import io
+import os
+import pathlib
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import patchfilter
+
+corpus = pathlib.Path(__file__).resolve().parent / 'patchfilter'
+script = pathlib.Path(patchfilter.__file__).resolve()
+
+
+def patch_header(subject, rnd):
+    return [
+        'From %040x Mon Sep 17 00:00:00 2001' % rnd.getrandbits(160),
+        'From: Clear Linux <clear@example.org>',
+        'Date: Mon, 1 Jan 2024 00:00:00 +0000',
+        'Subject: [PATCH] %s' % subject,
+        '',
+        '---',
+        '',
+    ]
+
+
+def file_diff(path, hunks, rnd):
+    lines = [
+        'diff --git a/%s b/%s' % (path, path),
+        'index %07x..%07x 100644' % (rnd.getrandbits(28), rnd.getrandbits(28)),
+        '--- a/%s' % path,
+        '+++ b/%s' % path,
+    ]
+    for start, body in hunks:
+        removed = sum(1 for line in body if line[0] != '+')
+        added = sum(1 for line in body if line[0] != '-')
+        lines.append('@@ -%d,%d +%d,%d @@' % (start, removed, start, added))
+        lines.extend(body)
+    return lines
+
+
+def synthetic_symbols(scale, rnd):
+    # A soname bump: every symbol of a big library changes
+    lines = patch_header('libfoo: Autospec creation for update from version 1.0 to 2.0', rnd)
+    for name in ('symbols', 'symbols32'):
+        body = list()
+        for i in range(20000 * scale):
+            body.append('-libfoo.so.1:foo_%d' % i)
+            body.append('+libfoo.so.2:foo_%d' % i)
+        lines += file_diff(name, [(1, body)], rnd)
+    lines += file_diff('release', [(1, ['-1', '+2'])], rnd)
+    return lines
+
+
+def synthetic_vendor(scale, rnd):
+    # A vendored crate tree refresh: many small files with a few changes each
+    lines = patch_header('rustpkg: Autospec creation for update from version 1.0 to 1.1', rnd)
+    for i in range(2000 * scale):
+        body = [' fn f%d_%d() {}' % (i, j) for j in range(3)]
+        body += ['-    let x = %d;' % rnd.randint(0, 99), '+    let x = %d;' % rnd.randint(0, 99)]
+        body += [' fn g%d_%d() {}' % (i, j) for j in range(3)]
+        lines += file_diff('vendor/crate%d/src/lib%d.rs' % (i % 97, i), [(10, body)], rnd)
+    return lines
+
+
+def synthetic_spec(scale, rnd):
+    # A spec rewrite where most changed lines are autospec boilerplate
+    noise = ['Release  : %d', 'Version  : 1.%d', 'export SOURCE_DATE_EPOCH=%d',
+             'Group: Binaries %d', 'cp -a foo-%d bar', 'rm -rf %%{buildroot} %d']
+    lines = patch_header('bigpkg: Autospec creation for update from version 1.0 to 1.1', rnd)
+    hunks = list()
+    for i in range(500 * scale):
+        body = [' context %d' % i]
+        for _ in range(4):
+            line = rnd.choice(noise) % i if rnd.random() < 0.8 else 'BuildRequires : dep%d' % i
+            body += ['-' + line, '+' + line.replace('1.', '2.')]
+        body.append(' context %d' % (i + 1))
+        hunks.append((i * 12 + 1, body))
+    lines += file_diff('bigpkg.spec', hunks, rnd)
+    return lines
+
+
+synthetic = {
+    'synthetic-symbols': synthetic_symbols,
+    'synthetic-vendor': synthetic_vendor,
+    'synthetic-spec': synthetic_spec,
+}
+
+
+def peak_rss(patch):
+    # Peak RSS in KB of a patchfilter.py process filtering patch
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([sys.executable, str(script), str(patch)], stdout=devnull)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return usage.ru_maxrss
+
+
+def filter_text(patch, rules):
+    out = io.StringIO(newline='')
+    sections = patchfilter.parse_patch(patchfilter.file_lines(patch))
+    patchfilter.write_patch(patchfilter.filter_patch(sections, rules), out)
+    return out.getvalue()
+
+
+def time_filter(patch, rules, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        filter_text(patch, rules)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def rule_times(patches, rule_list, repeat):
+    # Time of each rule applied alone to every patch, parsing excluded
+    parsed = [patchfilter.PatchSet.parse(patchfilter.file_lines(patch)) for patch in patches]
+    times = list()
+    for name, args in rule_list:
+        total = 0.0
+        for original in parsed:
+            best = None
+            for _ in range(repeat):
+                patchset = original.copy()
+                start = time.perf_counter()
+                getattr(patchset, name)(*args)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            total += best
+        times.append((total, name, args))
+    return sorted(times, reverse=True)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark patchfilter.py.')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='size multiplier for the synthetic patches')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per measurement, the best one is reported')
+    parser.add_argument('--rules', type=int, default=10, metavar='N',
+                        help='show the N most expensive rules (0 to skip per-rule timing)')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    rules = patchfilter.load_rules()
+    rnd = random.Random(1)
+    ok = True
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        patches = sorted(corpus.glob('*.patch'))
+        for name, generate in synthetic.items():
+            path = pathlib.Path(tmpdir) / (name + '.patch')
+            path.write_text('\n'.join(generate(args.scale, rnd)) + '\n')
+            patches.append(path)
+
+        print('%-20s %9s %8s %9s %10s %8s %8s  %s' %
+              ('patch', 'lines', 'MB', 'seconds', 'lines/s', 'MB/s', 'RSS MB', 'golden'))
+        for patch in patches:
+            size = patch.stat().st_size
+            with patch.open() as f:
+                nlines = sum(1 for _ in f)
+            seconds = time_filter(patch, rules, args.repeat)
+            rss = peak_rss(patch)
+
+            golden = patch.with_suffix('.golden')
+            if golden.exists():
+                with golden.open(newline='') as f:
+                    matches = filter_text(patch, rules) == f.read()
+                ok = ok and matches
+                result = 'ok' if matches else 'MISMATCH'
+            else:
+                result = '-'
+            print('%-20s %9d %8.2f %9.4f %10.0f %8.2f %8.1f  %s' %
+                  (patch.stem, nlines, size / 1e6, seconds, nlines / seconds,
+                   size / 1e6 / seconds, rss / 1024, result))
+
+        if args.rules > 0:
+            rule_list = patchfilter.read_rules(patchfilter.RULES_FILE)
+            print()
+            print('Most expensive rules, each applied alone to all patches:')
+            for total, name, rule_args in rule_times(patches, rule_list, args.repeat)[:args.rules]:
+                print('%9.4fs  %s %s' % (total, name, ' '.join(repr(a) for a in rule_args)))
+
+    if not ok:
+        print('Output differs from the golden files', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
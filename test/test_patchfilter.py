@@ -0,0 +1,301 @@
+import unittest
+import io, os, pathlib, random, re, subprocess, tempfile
+
+import patchfilter
+
+corpus = pathlib.Path(__file__).parent / 'patchfilter'
+
+def corpus_patches():
+    return sorted(corpus.glob('*.patch'))
+
+class GoldenOutputTestCase(unittest.TestCase):
+    '''Filtered output of every corpus patch must match its .golden file.'''
+    def setUp(self):
+        self.rules = patchfilter.load_rules(cache_dir=tempfile.mkdtemp())
+
+    def golden(self, patch):
+        with patch.with_suffix('.golden').open(newline='') as f:
+            return f.read()
+
+    def testStream(self):
+        for patch in corpus_patches():
+            with self.subTest(patch=patch.name):
+                out = io.StringIO(newline='')
+                sections = patchfilter.parse_patch(patchfilter.file_lines(patch))
+                patchfilter.write_patch(patchfilter.filter_patch(sections, self.rules), out)
+                self.assertEqual(out.getvalue(), self.golden(patch))
+
+    def testPatchSet(self):
+        for patch in corpus_patches():
+            with self.subTest(patch=patch.name):
+                out = io.StringIO(newline='')
+                p = patchfilter.PatchSet.parse(patchfilter.file_lines(patch))
+                p.filter(self.rules)
+                p.write(out)
+                self.assertEqual(out.getvalue(), self.golden(patch))
+
+    def testPatchSetMethods(self):
+        rules = patchfilter.read_rules(patchfilter.RULES_FILE)
+        for patch in corpus_patches():
+            with self.subTest(patch=patch.name):
+                original = patchfilter.PatchSet.parse(patchfilter.file_lines(patch))
+                p = original.copy()
+                for name, args in rules:
+                    getattr(p, name)(*args)
+                p.zap_empty_chunks()
+                out = io.StringIO(newline='')
+                p.write(out)
+                self.assertEqual(out.getvalue(), self.golden(patch))
+                # the copy was filtered, not the original
+                self.assertEqual(len(list(original.live_files())), len(original.files))
+                out = io.StringIO(newline='')
+                original.write(out)
+                unfiltered = io.StringIO(newline='')
+                patchfilter.write_patch(patchfilter.parse_patch(patchfilter.file_lines(patch)), unfiltered)
+                self.assertEqual(out.getvalue(), unfiltered.getvalue())
+
+    def testPatchSetTombstones(self):
+        p = patchfilter.PatchSet.parse(patchfilter.file_lines(corpus / 'small-bump.patch'))
+        names = [file.name for file in p.files]
+        name = names[0]
+        p.zap_entire_file(name)
+        self.assertIsNone(p.files[0])
+        self.assertEqual(p.positions(name), [])
+        self.assertEqual([file.name for file in p.live_files()], names[1:])
+        self.assertEqual([file.name for file in p.copy().files], names[1:])
+        p.zap_plus_line_in_file('')
+        for file in p.live_files():
+            for hunk in file.hunks:
+                self.assertEqual(hunk.plus, 0)
+        p.zap_empty_chunks()
+        self.assertEqual(list(p.live_files()), [])
+
+    def testPatchSetStats(self):
+        for patch in corpus_patches():
+            with self.subTest(patch=patch.name):
+                p = patchfilter.PatchSet.parse(patchfilter.file_lines(patch))
+                stats = patchfilter.FilterStats(self.rules)
+                p.filter(self.rules, stats)
+                out = io.StringIO(newline='')
+                p.write(out)
+                self.assertEqual(out.getvalue(), self.golden(patch))
+                self.assertEqual(stats.data['lines_out'], out.getvalue().count('\n'))
+
+    def testStats(self):
+        runs = list()
+        for patch in corpus_patches():
+            with self.subTest(patch=patch.name):
+                out = io.StringIO(newline='')
+                stats = patchfilter.FilterStats(self.rules)
+                sections = patchfilter.parse_patch(patchfilter.file_lines(patch))
+                patchfilter.write_patch(patchfilter.filter_patch(sections, self.rules, stats), out)
+                self.assertEqual(out.getvalue(), self.golden(patch))
+                self.assertEqual(stats.data['lines_out'], out.getvalue().count('\n'))
+                runs.append(stats.data)
+        merged = patchfilter.merge_stats(runs)
+        self.assertEqual(merged['patches'], len(runs))
+        self.assertEqual(merged['rule_hits'].keys(), runs[0]['rule_hits'].keys())
+        self.assertGreater(merged['rule_hits']['zap_plus_line_in_file symbols'], 0)
+        self.assertGreater(merged['files_in'], merged['files_out'])
+
+class RuleTableTestCase(unittest.TestCase):
+    def testTrieRegex(self):
+        import re
+        r = re.compile(patchfilter.trie_regex(['Group: Data', 'Group: Dev', 'Group:', 'export AR']))
+        self.assertTrue(r.match('Group: anything'))
+        self.assertTrue(r.match('export AR=gcc-ar'))
+        self.assertFalse(r.match('export CC'))
+        self.assertFalse(r.match(' Group:'))
+
+    def testExactRulesOnlyMatchTheirFile(self):
+        rules = patchfilter.RuleTable()
+        rules.zap_line_in_file('b/Makefile', '')
+        self.assertTrue(rules.for_file('b/Makefile').drops('+'))
+        self.assertTrue(rules.for_file('b/x/b/Makefile').empty)
+
+    def testPackageOverrides(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp)
+            (path / 'rules').write_text('zap_entire_file b/release\nzap_line_in_file_start .spec "Version  :"\n')
+            (path / 'override').write_text('!zap_entire_file b/release\nzap_entire_file b/NEWS\n')
+            rules = patchfilter.load_rules(path / 'rules', path / 'override', cache_dir=path / 'cache')
+            self.assertIsNotNone(rules.for_file('b/release'))
+            self.assertIsNone(rules.for_file('b/NEWS'))
+            self.assertTrue(rules.for_file('b/foo.spec').drops('-Version  : 1.0'))
+
+            # a cached load gives the same table
+            cached = patchfilter.load_rules(path / 'rules', path / 'override', cache_dir=path / 'cache')
+            self.assertEqual(cached.pattern_sources(), rules.pattern_sources())
+            self.assertEqual(cached.files, rules.files)
+
+    def testRunFromCommonDirectory(self):
+        # projects/common's own patchfilter_rules is the default rule file,
+        # not a package override to add to it
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(os.path.dirname(patchfilter.RULES_FILE))
+            self.addCleanup(os.chdir, cwd)
+            package_rules = os.path.join(patchfilter.package_directory(), patchfilter.PACKAGE_RULES_FILE)
+            rules = patchfilter.load_rules(patchfilter.RULES_FILE, package_rules, cache_dir=tmp)
+            self.assertEqual(rules.rules, patchfilter.read_rules(patchfilter.RULES_FILE))
+            self.assertEqual(rules.digest(), patchfilter.load_rules(cache_dir=tmp).digest())
+
+    def testInvalidRule(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / 'rules'
+            path.write_text('zap_entire_file\n')
+            self.assertRaises(ValueError, patchfilter.read_rules, path)
+
+class OutputCacheTestCase(unittest.TestCase):
+    def put(self, cache, key, text):
+        with cache.create() as cfile:
+            cfile.write(text)
+        cache.store(cfile.name, key)
+
+    def get(self, cache, key):
+        cfile = cache.open(key)
+        if cfile is None:
+            return None
+        with cfile:
+            return cfile.read()
+
+    def testLeastRecentlyUsedEviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = patchfilter.OutputCache(tmp, max_entries=2)
+            rules = patchfilter.load_rules(cache_dir=tmp + '/rules')
+            keys = [cache.key('%040x' % n, rules, False) for n in range(3)]
+            self.assertNotEqual(cache.key('0' * 40, rules, True), keys[0])
+            self.put(cache, keys[0], 'zero\n')
+            self.put(cache, keys[1], 'one\r\n')
+            os.utime(os.path.join(tmp, keys[1]), (0, 0))
+            self.assertEqual(self.get(cache, keys[0]), 'zero\n')
+            self.put(cache, keys[2], 'two\n')
+            self.assertIsNone(self.get(cache, keys[1]))
+            self.assertEqual(self.get(cache, keys[0]), 'zero\n')
+            self.assertEqual(self.get(cache, keys[2]), 'two\n')
+            self.assertEqual(sorted(os.listdir(tmp)), sorted([keys[0], keys[2], 'rules']))
+
+    def testSizeEviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = patchfilter.OutputCache(tmp, max_mb=1)
+            text = 'x' * (300 * 1024) + '\n'
+            for n in range(3):
+                self.put(cache, str(n), text)
+                os.utime(os.path.join(tmp, str(n)), (n, n))
+            self.assertEqual(self.get(cache, '0'), text)
+            self.put(cache, '3', text)
+            self.assertIsNone(self.get(cache, '1'))
+            self.assertEqual(sorted(os.listdir(tmp)), ['0', '2', '3'])
+
+class GitObjectsTestCase(unittest.TestCase):
+    '''--git-objects output must match filtered "git format-patch --no-stat
+    --no-signature" output.'''
+    def git(self, *args):
+        env = dict(os.environ, GIT_AUTHOR_NAME='Clëar Lïnux', GIT_AUTHOR_EMAIL='clear@example.org',
+                   GIT_COMMITTER_NAME='Clear Linux', GIT_COMMITTER_EMAIL='clear@example.org',
+                   GIT_CONFIG_NOSYSTEM='1', HOME=self.repo)
+        out = subprocess.run(['git'] + list(args), cwd=self.repo, env=env, check=True, stdout=subprocess.PIPE).stdout
+        return out.decode('utf-8', errors='replace')
+
+    def write(self, name, text, mode=0o644):
+        path = pathlib.Path(self.repo) / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+        path.chmod(mode)
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo = tmp.name
+        self.rules = patchfilter.load_rules(cache_dir=os.path.join(tmp.name, '.cache'))
+        self.git('init', '-q')
+        self.write('main.c', 'int main()\n{\n\treturn 0;\n}\n')
+        self.write('src/lib/util.txt', 'one\ntwo\nthree\n')
+        self.write('old.txt', 'gone\n')
+        self.write('run.sh', '#!/bin/sh\necho hi\n')
+        self.write('tail.txt', 'no newline')
+        self.write('docs/README', ''.join('line %d\n' % n for n in range(20)))
+        self.write('release', '1\n')
+        self.git('add', '.')
+        self.git('commit', '-q', '-m', 'first')
+
+        self.write('main.c', 'int main()\n{\n\treturn 1;\n}\n')		# modify, in a function
+        self.write('src/lib/util.txt', 'one\n2\nthree\nfour\n')	# nested directory
+        self.git('rm', '-q', 'old.txt')					# delete
+        self.write('run.sh', '#!/bin/sh\necho hello\n', 0o755)		# mode change
+        self.write('tail.txt', 'still no newline')			# no newline at EOF
+        self.write('src/new/file.txt', 'new\n')				# add, new directory
+        self.git('mv', 'docs/README', 'README.md')			# rename
+        self.write('release', '2\n')					# dropped by the rules
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', 'Sëcond change, with a subject long enough for format-patch to fold it '
+                 'over several lines', '-m', 'with a bödy')
+
+    def filtered(self, git_objects, cache=None):
+        out = io.StringIO(newline='')
+        patchfilter.write_filtered(self.rules, git_objects, out, cache, cwd=self.repo)
+        return out.getvalue()
+
+    def format_patch(self):
+        text = self.git('format-patch', '-1', '--stdout', '--no-stat', '--no-signature')
+        out = io.StringIO(newline='')
+        sections = patchfilter.parse_patch(re.findall(r'[^\n]*\n|[^\n]+$', text))
+        patchfilter.write_patch(patchfilter.filter_patch(sections, self.rules), out)
+        return out.getvalue()
+
+    def testSameAsFormatPatch(self):
+        actual = self.filtered(True)
+        self.assertEqual(actual, self.format_patch())
+        for name in ('main.c', 'run.sh', 'src/lib/util.txt', 'src/new/file.txt', 'tail.txt'):
+            self.assertIn('diff --git a/%s b/%s\n' % (name, name), actual)
+        self.assertIn('From: =?UTF-8?q?Cl=C3=ABar=20L=C3=AFnux?= <clear@example.org>\n', actual)
+        self.assertIn('old mode 100644\nnew mode 100755\n', actual)
+        self.assertIn('\\ No newline at end of file\n', actual)
+        self.assertNotIn('release', actual)
+
+    def testRandomEditsSameAsFormatPatch(self):
+        # few distinct lines, so there are many equally short diffs and
+        # only git's own algorithm picks the same one
+        rnd = random.Random(1)
+        words = ['a', 'b', 'c', '}', '']
+        lines = [rnd.choice(words) + '\n' for _ in range(60)]
+        for n in range(10):
+            for _ in range(rnd.randint(1, 6)):
+                pos = rnd.randrange(len(lines))
+                op = rnd.choice(('insert', 'delete', 'replace'))
+                if op == 'insert':
+                    lines[pos:pos] = [rnd.choice(words) + '\n' for _ in range(rnd.randint(1, 4))]
+                elif op == 'delete':
+                    del lines[pos:pos + rnd.randint(1, 4)]
+                else:
+                    lines[pos] = rnd.choice(words) + '\n'
+            self.write('data.txt', ''.join(lines))
+            self.git('add', '-A')
+            self.git('commit', '-q', '--allow-empty', '-m', 'edit %d' % n)
+            with self.subTest(commit=n):
+                self.assertEqual(self.filtered(True), self.format_patch())
+
+    def testDroppedPaths(self):
+        modify = ('100644', '1' * 40), ('100644', '2' * 40)
+        changes = [('release', *modify), ('main.c', *modify), ('gone.c', modify[0], None)]
+        self.assertEqual(list(patchfilter.dropped_paths(self.rules, changes)), ['release', 'gone.c'])
+        # a removed file may be the source of a rename
+        changes.append(('new.c', None, modify[1]))
+        self.assertEqual(list(patchfilter.dropped_paths(self.rules, changes)), ['release'])
+
+    def testCachedOutput(self):
+        cache = patchfilter.OutputCache(os.path.join(self.repo, '.cache', 'for-review'))
+        expected = self.filtered(True)
+        self.assertEqual(self.filtered(True, cache), expected)
+        self.assertEqual(len(os.listdir(cache.cache_dir)), 1)
+        self.assertEqual(self.filtered(True, cache), expected)
+
+    def testInterruptedOutputIsNotCached(self):
+        class Interrupted(patchfilter.RuleTable):
+            def for_file(self, file):
+                raise KeyboardInterrupt
+        cache = patchfilter.OutputCache(os.path.join(self.repo, '.cache', 'for-review'))
+        self.rules = Interrupted()
+        with self.assertRaises(KeyboardInterrupt):
+            self.filtered(True, cache)
+        self.assertEqual(os.listdir(cache.cache_dir), [])
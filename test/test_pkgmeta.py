@@ -0,0 +1,55 @@
+import unittest
+import os, pathlib, tempfile
+
+import pkgmeta
+
+MAKEFILE = '''PKG_NAME := foo
+URL = https://example.org/foo-1.0.tar.gz
+ARCHIVES = https://example.org/extra.tar.gz ./extra
+'''
+
+OPTIONS = '''[package]
+name = foo
+url = https://example.org/foo-1.0.tar.gz
+archives = https://example.org/extra.tar.gz ./extra
+
+[autospec]
+cargo_vendor = true
+'''
+
+class VendorTagTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name)
+        (self.path / 'Makefile').write_text(MAKEFILE)
+        (self.path / 'options.conf').write_text(OPTIONS)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def testAddThenReplace(self):
+        self.assertIsNone(pkgmeta.vendor_tag('foo', self.path))
+        archives = pkgmeta.set_vendor_tag('foo', '2024-01-02-03-04-05', self.path)
+        self.assertEqual(archives, ['ARCHIVES = https://example.org/extra.tar.gz ./extra '
+                                    '$(CGIT_BASE_URL)/vendor/foo/snapshot/foo-2024-01-02-03-04-05.tar.gz ./vendor\n'])
+        self.assertEqual(pkgmeta.vendor_tag('foo', self.path), '2024-01-02-03-04-05')
+
+        pkgmeta.set_vendor_tag('foo', '2025-01-02-03-04-05', self.path)
+        self.assertEqual(pkgmeta.vendor_tag('foo', self.path), '2025-01-02-03-04-05')
+        options = (self.path / 'options.conf').read_text()
+        self.assertIn('archives = https://example.org/extra.tar.gz ./extra '
+                      'http://localhost/cgit/vendor/foo/snapshot/foo-2025-01-02-03-04-05.tar.gz ./vendor\n', options)
+        self.assertNotIn('2024-01-02', options)
+        self.assertIn('cargo_vendor = true\n', options)
+
+    def testWriteFileKeepsMode(self):
+        os.chmod(self.path / 'Makefile', 0o600)
+        pkgmeta.write_file(str(self.path / 'Makefile'), 'x\n')
+        self.assertEqual((self.path / 'Makefile').read_text(), 'x\n')
+        self.assertEqual(os.stat(self.path / 'Makefile').st_mode & 0o777, 0o600)
+        self.assertEqual(sorted(os.listdir(self.path)), ['Makefile', 'options.conf'])
+
+    def testPackageUrl(self):
+        self.assertEqual(pkgmeta.package_url(self.path), 'https://example.org/foo-1.0.tar.gz')
+        (self.path / 'options.conf').write_text('[autospec]\n')
+        self.assertEqual(pkgmeta.package_url(self.path), 'https://example.org/foo-1.0.tar.gz')
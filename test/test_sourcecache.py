@@ -0,0 +1,112 @@
+import unittest
+import http.server, os, pathlib, tempfile, threading
+
+import sourcecache
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+class ArchiveServer(http.server.HTTPServer):
+    '''Serves body at any path with an ETag, answering If-None-Match with 304.'''
+    def __init__(self, body, etag):
+        super().__init__(('127.0.0.1', 0), ArchiveHandler)
+        self.body = body
+        self.etag = etag
+        self.codes = []
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == self.server.etag:
+            self.server.codes.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.server.codes.append(200)
+        self.send_response(200)
+        self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+class SourceCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name)
+        self.cache = str(self.path / 'cache')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def archive(self, name, size):
+        path = self.path / name
+        path.write_bytes(os.urandom(size))
+        return path
+
+    def testGetPut(self):
+        archive = self.archive('foo-1.0.tar.gz', 1000)
+        self.assertFalse(sourcecache.get('https://example.org/foo-1.0.tar.gz', str(self.path / 'out'), self.cache))
+        sourcecache.put('https://example.org/foo-1.0.tar.gz', str(archive), self.cache)
+        self.assertTrue(sourcecache.get('https://example.org/foo-1.0.tar.gz', str(self.path / 'out'), self.cache))
+        self.assertEqual((self.path / 'out').read_bytes(), archive.read_bytes())
+        # the same content under another URL is stored once
+        sourcecache.put('https://mirror.example.org/foo-1.0.tar.gz', str(archive), self.cache)
+        objects = [f for _, _, files in os.walk(self.path / 'cache' / 'objects') for f in files]
+        self.assertEqual(len(objects), 1)
+
+    def testFilesAreCopies(self):
+        archive = self.archive('foo-1.0.tar.gz', 1000)
+        data = archive.read_bytes()
+        sourcecache.put('u', str(archive), self.cache)
+        archive.write_bytes(b'garbage')
+        out = self.path / 'out'
+        self.assertTrue(sourcecache.get('u', str(out), self.cache))
+        with open(out, 'wb') as f:
+            f.write(b'garbage')
+        self.assertTrue(sourcecache.get('u', str(out), self.cache))
+        self.assertEqual(out.read_bytes(), data)
+
+    def testCorruptArchiveIsDropped(self):
+        sha256 = sourcecache.put('u', str(self.archive('foo-1.0.tar.gz', 1000)), self.cache)
+        pathlib.Path(sourcecache.object_path(self.cache, sha256)).write_bytes(b'garbage')
+        self.assertFalse(sourcecache.get('u', str(self.path / 'out'), self.cache))
+        self.assertFalse((self.path / 'out').exists())
+        self.assertIsNone(sourcecache.read_entry(self.cache, 'u'))
+
+    @unittest.skipIf(requests is None, 'requests is not installed')
+    def testFetchRevalidates(self):
+        server = ArchiveServer(os.urandom(1000), '"v1"')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d/foo-1.0.tar.gz' % server.server_port
+        out = self.path / 'out'
+
+        self.assertEqual(sourcecache.fetch(url, str(out), self.cache), 1000)
+        self.assertEqual(sourcecache.fetch(url, str(out), self.cache), 0)
+        self.assertEqual(out.read_bytes(), server.body)
+        self.assertEqual(server.codes, [200, 304])
+
+        server.body, server.etag = os.urandom(500), '"v2"'
+        self.assertEqual(sourcecache.fetch(url, str(out), self.cache), 500)
+        self.assertEqual(out.read_bytes(), server.body)
+
+        # a 304 for an archive that went bad downloads it again
+        entry = sourcecache.read_entry(self.cache, url)
+        pathlib.Path(sourcecache.object_path(self.cache, entry['sha256'])).write_bytes(b'garbage')
+        self.assertEqual(sourcecache.fetch(url, str(out), self.cache), 500)
+        self.assertEqual(out.read_bytes(), server.body)
+        self.assertEqual(server.codes, [200, 304, 200, 304, 200])
+
+    def testLeastRecentlyUsedEviction(self):
+        for n in range(3):
+            sourcecache.put('u%d' % n, str(self.archive('f%d' % n, 600 * 1024)), self.cache, max_mb=2)
+        # using u0 makes u1 the least recently used
+        sourcecache.get('u0', str(self.path / 'out'), self.cache)
+        sourcecache.put('u3', str(self.archive('f3', 600 * 1024)), self.cache, max_mb=2)
+        cached = [sourcecache.read_entry(self.cache, 'u%d' % n) is not None for n in range(4)]
+        self.assertEqual(cached, [True, False, True, True])
@@ -0,0 +1,220 @@
+import unittest
+import http.server, os, pathlib, shutil, subprocess, tarfile, tempfile, threading, time
+
+import pkgmeta
+
+try:
+    import vendor
+except ImportError:
+    # vendor.py needs requests and GitPython
+    vendor = None
+
+class SnapshotServer(http.server.HTTPServer):
+    '''A cgit stand-in whose snapshot appears after ready_after requests.'''
+    def __init__(self, ready_after):
+        super().__init__(('127.0.0.1', 0), SnapshotHandler)
+        self.ready_after = ready_after
+        self.requests = 0
+
+class SnapshotHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        self.send_response(200 if self.server.requests > self.server.ready_after else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@unittest.skipIf(vendor is None, 'vendor.py dependencies are not installed')
+class WaitForSnapshotTestCase(unittest.TestCase):
+    def serve(self, ready_after):
+        server = SnapshotServer(ready_after)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, 'http://127.0.0.1:%d/snapshot.tar.gz' % server.server_port
+
+    def testReady(self):
+        server, url = self.serve(2)
+        start = time.monotonic()
+        self.assertTrue(vendor.wait_for_snapshot(url, 10, delay=0.01))
+        self.assertEqual(server.requests, 3)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def testTimeout(self):
+        server, url = self.serve(1000)
+        self.assertFalse(vendor.wait_for_snapshot(url, 0.2, delay=0.01, max_delay=0.05))
+        self.assertGreater(server.requests, 1)
+
+@unittest.skipIf(vendor is None, 'vendor.py dependencies are not installed')
+class BackendTestCase(unittest.TestCase):
+    def tree(self, files):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name in files:
+            path = pathlib.Path(tmp.name) / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(name)
+        return tmp.name
+
+    def testCargoDiscover(self):
+        path = self.tree(['foo-1.0/Cargo.toml', 'foo-1.0/Cargo.lock', 'foo-1.0/crates/a/Cargo.toml', 'foo-1.0/README'])
+        found = sorted(os.path.relpath(p, path) for p in vendor.CargoBackend().discover(path))
+        self.assertEqual(found, ['foo-1.0/Cargo.toml', 'foo-1.0/crates/a/Cargo.toml'])
+
+    def testCargoDiscoverWorkspace(self):
+        path = self.tree(['foo-1.0/Cargo.lock', 'foo-1.0/crates/a/Cargo.toml', 'foo-1.0/crates/b/Cargo.toml',
+                          'foo-1.0/tools/c/Cargo.toml', 'foo-1.0/tests/fixture/Cargo.toml',
+                          'foo-1.0/vendor/dep/Cargo.toml', 'foo-1.0/examples/ex/Cargo.toml'])
+        root = pathlib.Path(path) / 'foo-1.0'
+        (root / 'Cargo.toml').write_text('[workspace]\nmembers = ["crates/*", "tools/c"]\nexclude = ["crates/b"]\n')
+        found = sorted(os.path.relpath(p, path) for p in vendor.CargoBackend().discover(path))
+        self.assertEqual(found, ['foo-1.0/Cargo.toml', 'foo-1.0/crates/b/Cargo.toml'])
+
+    def testGoDiscoverFindsTheMainModule(self):
+        path = self.tree(['foo-1.0/tools/go.mod', 'foo-1.0/go.mod', 'foo-1.0/go.sum', 'foo-1.0/a/b/go.mod'])
+        self.assertEqual(vendor.GoBackend().discover(path), [os.path.join(path, 'foo-1.0', 'go.mod')])
+
+    def testCargoWants(self):
+        wants = vendor.CargoBackend().wants
+        self.assertTrue(wants(tarfile.TarInfo('foo-1.0/Cargo.lock')))
+        self.assertTrue(wants(tarfile.TarInfo('foo-1.0/src/lib.rs')))
+        self.assertTrue(wants(tarfile.TarInfo('foo-1.0/.cargo/config.toml')))
+        self.assertFalse(wants(tarfile.TarInfo('foo-1.0/docs/index.html')))
+        self.assertFalse(wants(tarfile.TarInfo('foo-1.0/config.toml')))
+
+    def fingerprint(self, backend, version, lock, manifest_extra=''):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = pathlib.Path(tmp.name) / ('foo-%s' % version)
+        root.mkdir()
+        (pathlib.Path(tmp.name) / 'vendor').mkdir()
+        (root / 'Cargo.toml').write_text('[package]\nname = "foo"\nversion = "%s"\n\n[dependencies]\nlibc = "0.2"\n%s'
+                                         % (version, manifest_extra))
+        if lock is not None:
+            (root / 'Cargo.lock').write_text(lock % version)
+        return backend.fingerprint(tmp.name, [str(root / 'Cargo.toml')])
+
+    def testCargoFingerprintIgnoresOwnVersion(self):
+        backend = vendor.CargoBackend()
+        backend.version_cmd = 'echo cargo 1.0'
+        lock = ('version = 3\n\n[[package]]\nname = "foo"\nversion = "%s"\ndependencies = [\n "libc",\n]\n\n'
+                '[[package]]\nname = "libc"\nversion = "0.2.1"\n'
+                'source = "registry+https://github.com/rust-lang/crates.io-index"\nchecksum = "ab"\n')
+        old = self.fingerprint(backend, '1.0', lock)
+        self.assertIsNotNone(old)
+        self.assertEqual(self.fingerprint(backend, '1.1', lock), old)
+        self.assertNotEqual(self.fingerprint(backend, '1.1', lock.replace('0.2.1', '0.2.2')), old)
+        self.assertNotEqual(self.fingerprint(backend, '1.1', lock, 'serde = "1"\n'), old)
+        self.assertIsNone(self.fingerprint(backend, '1.0', None))
+
+    def go_fingerprint(self, version, imports):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = pathlib.Path(tmp.name) / ('foo-%s' % version)
+        for package in ('a', 'b'):
+            (root / 'dep' / package).mkdir(parents=True)
+            (root / 'dep' / package / (package + '.go')).write_text('package %s\n' % package)
+        (root / 'dep' / 'go.mod').write_text('module example.org/dep\n\ngo 1.18\n')
+        (root / 'vendor').mkdir()
+        (root / 'go.mod').write_text('module example.org/foo\n\ngo 1.18\n\nrequire example.org/dep v0.0.0\n\n'
+                                     'replace example.org/dep => ./dep\n')
+        (root / 'go.sum').write_text('')
+        (root / 'main.go').write_text('package main\n\nimport (\n%s)\n\nfunc main() {}\n'
+                                      % ''.join('\t_ "example.org/dep/%s"\n' % package for package in imports))
+        return vendor.GoBackend().fingerprint(tmp.name, [str(root / 'go.mod')])
+
+    @unittest.skipUnless(shutil.which('go'), 'go is not installed')
+    def testGoFingerprintFollowsImports(self):
+        old = self.go_fingerprint('1.0', ['a'])
+        self.assertIsNotNone(old)
+        self.assertEqual(self.go_fingerprint('1.1', ['a']), old)
+        # a new package of a module that was already required
+        self.assertNotEqual(self.go_fingerprint('1.1', ['a', 'b']), old)
+        self.assertIsNone(self.go_fingerprint('1.1', ['c']))
+
+    def testExtractHardLinkToSkippedMember(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = pathlib.Path(tmp) / 'foo-1.0'
+            src.mkdir()
+            (src / 'README').write_text('readme')
+            os.link(src / 'README', src / 'lib.rs')
+            archive = os.path.join(tmp, 'foo-1.0.tar.gz')
+            with tarfile.open(archive, 'w:gz') as tar:
+                tar.add(str(src), 'foo-1.0')
+            out = os.path.join(tmp, 'out')
+            os.mkdir(out)
+            self.assertFalse(vendor.extract_vendor_files(archive, out, vendor.CargoBackend().wants))
+
+    def testBackendOptions(self):
+        self.assertEqual(sorted(vendor.BACKENDS), ['cargo', 'go'])
+
+@unittest.skipIf(vendor is None, 'vendor.py dependencies are not installed')
+class MirrorTestCase(unittest.TestCase):
+    def testFetchFailureKeepsMirror(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            origin = os.path.join(tmp, 'foo')
+            subprocess.run(['git', 'init', '-q', '--bare', origin], check=True)
+            mirror_dir = os.path.join(tmp, 'mirrors')
+            mirror = vendor.update_vendor_mirror(origin, 'foo', mirror_dir)
+            self.assertEqual(vendor.update_vendor_mirror(origin, 'foo', mirror_dir), mirror)
+
+            os.rename(origin, origin + '.moved')
+            self.assertRaises(subprocess.CalledProcessError, vendor.update_vendor_mirror, origin, 'foo', mirror_dir)
+            self.assertTrue(os.path.isfile(os.path.join(mirror, 'HEAD')))
+
+            # a mirror that isn't a repository any more is cloned again
+            os.rename(origin + '.moved', origin)
+            os.remove(os.path.join(mirror, 'HEAD'))
+            self.assertEqual(vendor.update_vendor_mirror(origin, 'foo', mirror_dir), mirror)
+            self.assertTrue(os.path.isfile(os.path.join(mirror, 'HEAD')))
+
+@unittest.skipIf(vendor is None, 'vendor.py dependencies are not installed')
+class BatchTestCase(unittest.TestCase):
+    def package(self, packages_dir, name, vendor_option):
+        path = pathlib.Path(packages_dir) / name
+        path.mkdir()
+        (path / 'Makefile').write_text('PKG_NAME := %s\nURL = https://example.org/%s-1.0.tar.gz\n'
+                                       'ARCHIVES = $(CGIT_BASE_URL)/vendor/%s/snapshot/%s-2024-01-02-03-04-05.tar.gz ./vendor\n'
+                                       % (name, name, name, name))
+        (path / 'options.conf').write_text('[package]\nname = %s\nurl = https://example.org/%s-1.0.tar.gz\n\n'
+                                           '[autospec]\n%s = true\n' % (name, name, vendor_option))
+        return str(path)
+
+    def testBatchPackages(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            foo = self.package(tmp, 'foo', 'cargo_vendor')
+            bar = self.package(tmp, 'bar', 'go_vendor')
+            self.package(tmp, 'baz', 'autoupdate')
+            self.assertEqual(vendor.batch_packages(tmp, []), [(bar, 'go'), (foo, 'cargo')])
+            self.assertEqual(vendor.batch_packages(tmp, ['foo', 'baz']), [(foo, 'cargo')])
+            self.assertEqual(pkgmeta.vendor_tag('foo', foo), '2024-01-02-03-04-05')
+            self.assertEqual(pkgmeta.package_url(foo), 'https://example.org/foo-1.0.tar.gz')
+
+@unittest.skipIf(vendor is None, 'vendor.py dependencies are not installed')
+class StatsTestCase(unittest.TestCase):
+    def testMeasureAndMerge(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            vendor_path = pathlib.Path(tmp) / 'vendor'
+            for name in ('a/Cargo.toml', 'b/src/lib.rs', '.git/HEAD'):
+                (vendor_path / name).parent.mkdir(parents=True, exist_ok=True)
+                (vendor_path / name).write_text('12345')
+            stats = vendor.VendorStats('foo', 'cargo')
+            with stats.phase('vendor'):
+                stats.measure(vendor.CargoBackend(), str(vendor_path))
+            self.assertEqual((stats.data['crates'], stats.data['vendor_files'], stats.data['vendor_bytes']), (2, 2, 10))
+            self.assertIn('vendor', stats.data['seconds'])
+
+            stats_file = os.path.join(tmp, 'stats', 'stats.jsonl')
+            vendor.write_stats(stats_file, stats.data)
+            vendor.write_stats(stats_file, stats.data)
+            total = vendor.merge_stats(vendor.read_stats([stats_file]))
+            self.assertEqual((total['runs'], total['crates']), (2, 4))
+            self.assertNotIn('package', total)
+            self.assertIn('vendor', vendor.format_stats(total))
+
+    def testGoCount(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pathlib.Path(tmp, 'modules.txt').write_text('# a.org/x v1.0\na.org/x\n# b.org/y v2.0\nb.org/y/z\n')
+            self.assertEqual(vendor.GoBackend().count(tmp), 2)
@@ -1,167 +1,841 @@
 #!/usr/bin/env python3
 
 import argparse
-import configparser
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import json
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
+import sys
+import tarfile
 import tempfile
 import time
 
 import requests
 from git import Repo
 
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11: no workspace pruning, see CargoBackend.discover()
+    tomllib = None
 
-def vendor_check():
-    if not os.path.isfile('options.conf'):
+import pkgmeta
+import sourcecache
+
+# Where autospec downloads vendor snapshots from, see update_sources()
+SNAPSHOT_URL = 'http://localhost/cgit/vendor/{name}/snapshot/{name}-{tag}.tar.gz'
+
+# Kept in the vendor repo next to the vendored sources; cargo skips
+# dotfiles in directory sources and go in vendor/
+VENDOR_FINGERPRINT = '.clear-vendor-fingerprint'
+
+# Phases of a vendor run, in order, as they appear in the stats
+PHASES = ('download', 'extract', 'discover', 'clone', 'fingerprint', 'vendor',
+          'commit', 'push', 'snapshot_wait', 'update_sources')
+
+
+class VendorStats:
+    # Where one package's vendor run spends its time, and how much it
+    # moves: appended as a JSON line to the stats file, as stdout is the
+    # archive list make reads.  data is plain JSON so a batch worker can
+    # hand it back to the parent, and merge_stats() adds runs up.
+    def __init__(self, name=None, backend=None, data=None):
+        self.data = data or {
+            'package': name,
+            'backend': backend,
+            'time': time.time(),
+            'runs': 1,
+            'seconds': {},
+            'bytes_downloaded': 0,	# 0 when the archive came from the cache
+            'archive_bytes': 0,
+            'manifests': 0,
+            'crates': 0,		# vendored crates or go modules
+            'vendor_files': 0,
+            'vendor_bytes': 0,
+            'vendored': 0,		# the vendor step ran
+            'tagged': 0,		# a new vendor tag was pushed
+        }
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = self.data['seconds']
+            seconds[name] = seconds.get(name, 0.0) + time.monotonic() - start
+
+    def measure(self, backend, vendor_path):
+        # Size of the vendored tree, less its git metadata
+        self.data['crates'] = backend.count(vendor_path)
+        files = size = 0
+        for dirpath, dirnames, filenames in os.walk(vendor_path):
+            if '.git' in dirnames:
+                dirnames.remove('.git')
+            for fname in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, fname)).st_size
+                except OSError:
+                    continue
+                files += 1
+        self.data['vendor_files'] = files
+        self.data['vendor_bytes'] = size
+
+
+def merge_stats(runs):
+    # Sum of the numbers in the stats of runs, per phase for the timings;
+    # package names and the like are dropped
+    total = {}
+    for data in runs:
+        for key, value in data.items():
+            if isinstance(value, dict):
+                merged = total.setdefault(key, {})
+                for name, number in value.items():
+                    merged[name] = merged.get(name, 0) + number
+            elif isinstance(value, (int, float)) and key != 'time':
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+def write_stats(stats_file, data):
+    # Append one run's stats; like the cache, a stats file that can't be
+    # written must not fail the vendor run
+    if not stats_file:
+        return
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(stats_file)), exist_ok=True)
+        with open(stats_file, 'a', encoding='utf8') as sfile:
+            sfile.write(json.dumps(data, sort_keys=True) + '\n')
+    except OSError as e:
+        print(f"cannot write vendor stats to {stats_file}: {e}", file=sys.stderr)
+
+
+def read_stats(paths):
+    runs = []
+    for path in paths:
+        with open(path, encoding='utf8') as sfile:
+            runs.extend(json.loads(line) for line in sfile if line.strip())
+    return runs
+
+
+def format_stats(total):
+    # Human readable summary of merge_stats() output
+    runs = total.get('runs', 0)
+    seconds = total.get('seconds', {})
+    wall = sum(seconds.values())
+    lines = [f"{runs} runs, {wall:.1f}s, {total.get('vendored', 0)} vendored, "
+             f"{total.get('tagged', 0)} tagged, {total.get('bytes_downloaded', 0) / 1e6:.1f} MB downloaded, "
+             f"{total.get('crates', 0)} crates, {total.get('vendor_bytes', 0) / 1e6:.1f} MB vendored"]
+    for name in sorted(seconds, key=lambda name: PHASES.index(name) if name in PHASES else len(PHASES)):
+        share = 100 * seconds[name] / wall if wall else 0
+        lines.append(f"  {name:<15} {seconds[name]:9.1f}s {share:5.1f}%")
+    return '\n'.join(lines)
+
+
+def scan_dir(path):
+    # (subdirectories, file names) of path, symlinks to directories are
+    # not followed, like os.walk()
+    dirs = []
+    files = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                else:
+                    files.append(entry.name)
+    except OSError:
+        pass
+    return dirs, files
+
+
+def parallel_walk(path, prune=frozenset(), jobs=8):
+    # Yields (dirpath, file names) for path and everything below it, one
+    # directory level at a time, scanning the directories of a level in a
+    # thread pool.  Directories named in prune are skipped.
+    level = [path]
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        while level:
+            next_level = []
+            for dirpath, (dirs, files) in zip(level, pool.map(scan_dir, level)):
+                yield dirpath, files
+                next_level.extend(d for d in dirs if os.path.basename(d) not in prune)
+            level = next_level
+
+
+class VendorBackend:
+    # One ecosystem's part of the vendoring pipeline.  The shared steps --
+    # fetching the archive, checking the vendor fingerprint, committing and
+    # tagging the vendor repo, rewriting the package's archives -- call
+    # into a backend for what differs: which archive members to extract,
+    # where the manifests are, what the vendored tree depends on and how
+    # to produce it.  A backend is enabled by "<name>_vendor = true" in the
+    # [autospec] section of options.conf.
+    name = None
+    version_cmd = None	# identifies the toolchain for the fingerprint
+    config_file = None	# package file the vendor step's output goes to
+
+    def wants(self, member):
+        # Whether the vendor step needs this archive member
+        return True
+
+    def discover(self, path):
+        # The manifests under the extracted sources, empty for nothing to
+        # vendor
+        raise NotImplementedError
+
+    def vendor(self, tmpdir, manifests):
+        # Create tmpdir/vendor; returns what goes in config_file
+        raise NotImplementedError
+
+    def count(self, vendor_path):
+        # Number of vendored packages, one directory each by default
+        try:
+            with os.scandir(vendor_path) as it:
+                return sum(1 for entry in it if entry.is_dir(follow_symlinks=False)
+                           and not entry.name.startswith('.'))
+        except OSError:
+            return 0
+
+    def dependencies(self, manifest):
+        # The dependency set the vendored tree for manifest is made from,
+        # as bytes, leaving out the package's own version so a version
+        # bump with the same dependencies keeps the fingerprint.  None when
+        # there is no lock file: the vendor step then resolves versions
+        # afresh and must always run.
+        raise NotImplementedError
+
+    def fingerprint(self, tmpdir, manifests):
+        # Everything the vendored tree depends on: the toolchain version
+        # and the dependencies of each manifest, or None when that isn't
+        # known.  Paths are relative to the source root, which is named
+        # after the version, and sorted as os.walk() order may differ
+        # between extractions.
+        digest = hashlib.sha256(self.name.encode() + b'\0')
+        version = subprocess.run(self.version_cmd, shell=True, check=True, stdout=subprocess.PIPE).stdout
+        digest.update(version)
+        root = source_root(tmpdir)
+        for path in sorted(manifests):
+            dependencies = self.dependencies(path)
+            if dependencies is None:
+                return None
+            digest.update(os.path.relpath(path, root).encode() + b'\0')
+            digest.update(hashlib.sha256(dependencies).digest())
+        return digest.hexdigest()
+
+
+def source_root(tmpdir):
+    # The top-level directory of the extracted archive, or tmpdir for an
+    # archive without one.  vendor/ is the vendor repo checkout.
+    entries = [entry for entry in os.scandir(tmpdir) if entry.name != 'vendor']
+    if len(entries) == 1 and entries[0].is_dir(follow_symlinks=False):
+        return entries[0].path
+    return tmpdir
+
+
+def read_bytes(path):
+    # Contents of path, or None when it doesn't exist
+    try:
+        with open(path, 'rb') as rfile:
+            return rfile.read()
+    except FileNotFoundError:
+        return None
+
+
+class CargoBackend(VendorBackend):
+    name = 'cargo'
+    version_cmd = 'cargo --version'
+    config_file = 'cargo_vendors'
+
+    def dependencies(self, manifest):
+        # The locked registry and git packages, the dependency tables of
+        # the manifest and the cargo config.  Cargo.lock entries without
+        # a source are the package's own crates, with its version.
+        manifest_dir = os.path.dirname(manifest)
+        lock = read_bytes(os.path.join(manifest_dir, 'Cargo.lock'))
+        if lock is None:
+            return None
+        parts = [locked_packages(lock.decode('utf8', 'replace')), manifest_dependencies(read_bytes(manifest))]
+        for fname in ('.cargo/config', '.cargo/config.toml'):
+            if (config := read_bytes(os.path.join(manifest_dir, fname))) is not None:
+                parts.append(fname.encode() + b'\0' + config)
+        return b'\0\0'.join(parts)
+
+    def wants(self, member):
+        # cargo vendor only reads the manifests, the lock file, cargo config
+        # and enough of each crate's sources for cargo to find its targets
+        name = os.path.basename(member.name)
+        parent = os.path.basename(os.path.dirname(member.name))
+        if member.issym() or member.islnk():
+            return True
+        if name in ('Cargo.toml', 'Cargo.lock'):
+            return True
+        if parent == '.cargo' and name in ('config', 'config.toml'):
+            return True
+        return name.endswith('.rs')
+
+    # Directories whose manifests are never worth vendoring for: test
+    # fixtures and examples, build output and already vendored crates
+    prune = frozenset(('.git', 'target', 'vendor', 'tests', 'examples', 'benches',
+                       'fixtures', 'testdata', 'node_modules'))
+
+    def discover(self, path):
+        # Every Cargo.toml outside the pruned directories, less the
+        # members of a workspace whose root manifest is already listed
+        # (cargo vendor of the root covers them)
+        cargo_paths = [os.path.join(dirpath, 'Cargo.toml') for dirpath, files in parallel_walk(path, self.prune)
+                       if 'Cargo.toml' in files]
+        members = set()
+        for cargo_path in cargo_paths:
+            members.update(self.workspace_members(cargo_path))
+        return sorted(cargo_path for cargo_path in cargo_paths if cargo_path not in members)
+
+    def workspace_members(self, cargo_path):
+        # The member manifests of the workspace cargo_path is the root of,
+        # from its [workspace] members globs less its excludes
+        if tomllib is None:
+            return set()
+        try:
+            with open(cargo_path, 'rb') as cfile:
+                workspace = tomllib.load(cfile).get('workspace')
+        except (OSError, ValueError):
+            return set()
+        if not isinstance(workspace, dict):
+            return set()
+        root = os.path.dirname(cargo_path)
+        excluded = {os.path.normpath(os.path.join(root, e)) for e in workspace.get('exclude', [])}
+        members = set()
+        for pattern in workspace.get('members', []):
+            for member in glob.glob(os.path.join(root, pattern)):
+                member = os.path.normpath(member)
+                manifest = os.path.join(member, 'Cargo.toml')
+                if member != root and member not in excluded and os.path.isfile(manifest):
+                    members.add(manifest)
+        return members
+
+    def vendor(self, tmpdir, manifests):
+        vendor_cmd = 'cargo vendor ' + ' '.join([f"-s {x}" for x in manifests[:-1]])
+        vendor_cmd += f" --manifest-path {manifests[-1]}"
+        return subprocess.run(vendor_cmd, cwd=tmpdir, shell=True,
+                              check=True, stdout=subprocess.PIPE,
+                              universal_newlines=True).stdout
+
+
+class GoBackend(VendorBackend):
+    # go mod vendor for the main module, the go.mod closest to the top of
+    # the sources.  All of the archive is extracted: which packages get
+    # vendored depends on the imports and build constraints of every
+    # .go file, and on the files their go:embed patterns name.
+    name = 'go'
+    version_cmd = 'go version'
+
+    def dependencies(self, manifest):
+        # go.sum is the lock file; go.mod names the module and its
+        # requirements, but not its version.  Neither says which packages
+        # of those modules get vendored, which follows the imports of the
+        # .go files, so the packages go list resolves for them are added.
+        # None when go list fails: go mod vendor then decides.
+        module_dir = os.path.dirname(manifest)
+        if not os.path.isfile(os.path.join(module_dir, 'go.sum')):
+            return None
+        parts = []
+        for fname in ('go.mod', 'go.sum', 'go.work', 'go.work.sum'):
+            if (content := read_bytes(os.path.join(module_dir, fname))) is not None:
+                parts.append(fname.encode() + b'\0' + content)
+        packages = go_packages(module_dir)
+        if packages is None:
+            return None
+        parts.append(b'packages\0' + packages)
+        return b'\0\0'.join(parts)
+
+    def discover(self, path):
+        modules = [os.path.join(dirpath, 'go.mod') for dirpath, _, files in os.walk(path) if 'go.mod' in files]
+        if len(modules) == 0:
+            return []
+        return [min(modules, key=lambda module: (module.count(os.sep), module))]
+
+    def vendor(self, tmpdir, manifests):
+        vendor_path = os.path.join(tmpdir, 'vendor')
+        subprocess.run(f"go mod vendor -o {vendor_path}", cwd=os.path.dirname(manifests[0]),
+                       shell=True, check=True, stdout=subprocess.DEVNULL)
+        # nothing is written for a module without dependencies
+        os.makedirs(vendor_path, exist_ok=True)
+        return ''
+
+    def count(self, vendor_path):
+        # vendor/ is laid out by import path, modules.txt lists the modules
+        try:
+            with open(os.path.join(vendor_path, 'modules.txt'), encoding='utf8') as mfile:
+                return sum(1 for line in mfile if line.startswith('# '))
+        except OSError:
+            return 0
+
+
+# One "module@version package" line per imported package that is not in
+# the main module or the standard library
+GO_LIST_FORMAT = '{{with .Module}}{{if not .Main}}{{.Path}}@{{.Version}} {{$.ImportPath}}{{end}}{{end}}'
+
+
+def go_packages(module_dir):
+    # Sorted packages the module's packages and their tests import, as go
+    # mod vendor would vendor them for linux, or None.  -mod=readonly
+    # because the archive may ship a vendor/ directory of its own.
+    env = dict(os.environ, GOOS='linux', GOFLAGS='')
+    proc = subprocess.run(['go', 'list', '-mod=readonly', '-deps', '-test', '-f', GO_LIST_FORMAT, './...'],
+                          cwd=module_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if proc.returncode != 0:
+        return None
+    return b'\n'.join(sorted(set(line for line in proc.stdout.splitlines() if line)))
+
+
+def locked_packages(lock):
+    # Sorted "name version source checksum" lines of the [[package]]
+    # entries of a Cargo.lock that come from a registry or git
+    packages = []
+    for block in lock.split('[[package]]')[1:]:
+        fields = dict(re.findall(r'^(name|version|source|checksum) = "(.*)"$', block, re.MULTILINE))
+        if 'source' in fields:
+            packages.append(' '.join(fields.get(key, '') for key in ('name', 'version', 'source', 'checksum')))
+    return '\n'.join(sorted(packages)).encode()
+
+
+def manifest_dependencies(manifest):
+    # A Cargo.toml without the version of its [package]
+    lines = []
+    section = None
+    for line in manifest.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith(b'['):
+            section = stripped
+        elif section == b'[package]' and re.match(rb'version\s*=', stripped):
+            continue
+        lines.append(line)
+    return b''.join(lines)
+
+
+BACKENDS = {backend.name: backend for backend in (CargoBackend, GoBackend)}
+
+
+def vendor_check(path='.'):
+    if not os.path.isfile(os.path.join(path, 'options.conf')):
         return False
-    config = configparser.ConfigParser(interpolation=None)
-    config.read('options.conf')
+    config = pkgmeta.read_options(path)
     if 'autospec' not in config.sections():
         return False
-    if vendor := config['autospec'].get('cargo_vendor'):
-        if vendor == "true":
-            return 'cargo'
+    for name in BACKENDS:
+        if config['autospec'].get(f"{name}_vendor") == "true":
+            return name
 
     return False
 
 
 def get_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('archives')
-    parser.add_argument('url')
-    parser.add_argument('name')
-    parser.add_argument('git')
-    return parser.parse_args()
+    parser.add_argument('--cache-dir', default=sourcecache.default_cache_dir(),
+                        help='shared archive cache, see sourcecache.py (empty to disable)')
+    parser.add_argument('--cache-max-mb', type=int, default=sourcecache.DEFAULT_MAX_MB)
+    parser.add_argument('--snapshot-url', default=SNAPSHOT_URL,
+                        help='snapshot URL template to wait for after pushing a new tag (default: %(default)s)')
+    parser.add_argument('--snapshot-timeout', type=float, default=300,
+                        help='seconds to wait for the snapshot to become available (default: %(default)s)')
+    parser.add_argument('--mirror-dir', default=default_mirror_dir(),
+                        help='local mirrors of the vendor repos (empty for a shallow clone each time)')
+    parser.add_argument('--stats-file', default=os.path.join(default_mirror_dir(), 'stats.jsonl'),
+                        help='append per-phase timings and sizes of each run here as JSON lines '
+                        '(default: %(default)s, empty to disable)')
+    parser.add_argument('--summarize-stats', nargs='+', metavar='FILE',
+                        help='print a summary of the runs in stats files and exit')
+    parser.add_argument('--batch', action='store_true',
+                        help='re-vendor every package under --packages-dir that has vendoring enabled '
+                        '(or just the PACKAGE names given), pushing to vendor repos under --vendor-git')
+    parser.add_argument('--packages-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                               '../../packages'),
+                        help='with --batch, where the package repos are checked out')
+    parser.add_argument('--vendor-git', metavar='URL', help='with --batch, base URL of the vendor repos')
+    parser.add_argument('--log-dir', help='with --batch, where per-package logs go (default: a new temporary dir)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='with --batch, number of vendor worker processes')
+    parser.add_argument('--download-jobs', type=int, default=4,
+                        help='with --batch, number of concurrent downloads')
+    parser.add_argument('archives', nargs='?')
+    parser.add_argument('url', nargs='?')
+    parser.add_argument('name', nargs='?')
+    parser.add_argument('git', nargs='?')
+    parser.add_argument('packages', nargs='*', metavar='PACKAGE', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.summarize_stats:
+        return args
+    if args.batch:
+        if not args.vendor_git:
+            parser.error('--batch needs --vendor-git')
+        # positional arguments are package names in batch mode
+        args.packages = [p for p in (args.archives, args.url, args.name, args.git) if p] + args.packages
+    elif args.git is None or args.packages:
+        parser.error('expected the arguments ARCHIVES URL NAME GIT')
+    return args
+
 
+def download(url, outfile, chunk_size=1 << 20):
+    # Stream the response to disk so big archives never sit in memory.
+    # Returns the number of bytes downloaded.
+    downloaded = 0
+    with requests.get(url, timeout=30, stream=True) as response:
+        response.raise_for_status()
+        with open(outfile, 'wb') as cfile:
+            for chunk in response.iter_content(chunk_size):
+                cfile.write(chunk)
+                downloaded += len(chunk)
+    return downloaded
 
-def setup_content(url):
+
+def extract_vendor_files(archive, tdir, wants):
+    # Single pass over the archive, extracting only the members wants()
+    # accepts.  Returns False when tarfile can't handle the archive, for
+    # the caller to extract all of it with tar: an unknown compression,
+    # or a hard link to a member that was skipped, which a stream can't
+    # seek back to.
+    kwargs = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+    try:
+        with tarfile.open(archive, 'r|*') as tar:
+            for member in tar:
+                if wants(member):
+                    tar.extract(member, tdir, **kwargs)
+    except tarfile.TarError:
+        return False
+    return True
+
+
+def setup_content(url, cache_dir=None, cache_max_mb=sourcecache.DEFAULT_MAX_MB, wants=None, stats=None):
+    stats = stats or VendorStats()
     tdir = tempfile.mkdtemp()
     outfile = os.path.join(tdir, os.path.basename(url))
-    response = requests.get(url, timeout=30)
-    response.raise_for_status()
-    with open(outfile, 'wb') as cfile:
-        cfile.write(response.content)
+    try:
+        with stats.phase('download'):
+            if cache_dir:
+                stats.data['bytes_downloaded'] = sourcecache.fetch(url, outfile, cache_dir, cache_max_mb)
+            else:
+                stats.data['bytes_downloaded'] = download(url, outfile)
+        stats.data['archive_bytes'] = os.path.getsize(outfile)
 
-    subprocess.run(f"tar xf {outfile}", shell=True, cwd=tdir, check=True, stdout=subprocess.DEVNULL)
-    os.remove(outfile)
+        with stats.phase('extract'):
+            if wants is None or not extract_vendor_files(outfile, tdir, wants):
+                # compressions tarfile doesn't know, such as zstd
+                subprocess.run(f"tar xf {outfile}", shell=True, cwd=tdir, check=True, stdout=subprocess.DEVNULL)
+        os.remove(outfile)
+    except BaseException:
+        shutil.rmtree(tdir)
+        raise
     return tdir
 
 
-def setup_cargo_vendor(path):
-    cargo_paths = []
-    for dirpath, _, files in os.walk(path):
-        for fname in files:
-            if fname == "Cargo.toml":
-                cargo_paths.append(os.path.join(dirpath, fname))
-    return cargo_paths
+def read_vendor_fingerprint(vendor_path):
+    try:
+        with open(os.path.join(vendor_path, VENDOR_FINGERPRINT), encoding='utf8') as ffile:
+            return json.load(ffile)
+    except (OSError, ValueError):
+        return None
 
 
-def update_cargo_vendor(tmpdir, cargo_paths, name, git):
-    git_uri = os.path.join(git, name)
-    vendor_path = os.path.join(tmpdir, 'vendor')
-    subprocess.run(f"git clone {git_uri} {vendor_path}", shell=True, check=True,
+def newest_tag(source):
+    # Always use the newest tag as sometimes a new tag will
+    # be created but the package won't be updated to use it
+    # for a different failure reason.  Tags are listed from
+    # source (the mirror or the vendor repo) as a shallow clone
+    # doesn't have them.
+    refs = subprocess.run(f"git ls-remote --tags --refs {source}", shell=True, check=True,
+                          stdout=subprocess.PIPE, universal_newlines=True).stdout
+    tags = [line.split('refs/tags/', 1)[1] for line in refs.splitlines() if 'refs/tags/' in line]
+    return sorted(tags, reverse=True)[0]
+
+
+def default_mirror_dir():
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache, 'clear-vendor')
+
+
+def update_vendor_mirror(git_uri, name, mirror_dir):
+    # Keep a local mirror of the vendor repo so each update only fetches
+    # the refs added since the last one.  A failed fetch (the network,
+    # another run holding a ref lock) is passed up: the mirror is only
+    # rebuilt when it isn't a repository any more, as other runs' shared
+    # clones may be using its objects.
+    mirror = os.path.join(mirror_dir, f"{name}.git")
+    if os.path.isdir(mirror):
+        usable = subprocess.run(f"git --git-dir={mirror} rev-parse --git-dir", shell=True,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if usable.returncode == 0:
+            subprocess.run('git fetch --prune --quiet', cwd=mirror, shell=True, check=True,
+                           stdout=subprocess.DEVNULL)
+            return mirror
+        shutil.rmtree(mirror)
+    os.makedirs(mirror_dir, exist_ok=True)
+    subprocess.run(f"git clone --mirror --quiet {git_uri} {mirror}", shell=True, check=True,
                    stdout=subprocess.DEVNULL)
-    vendor_git = os.path.join(vendor_path, '.git')
-    if not os.path.isdir(vendor_git):
-        # initialize a git repo
-        subprocess.run('git init .', cwd=vendor_path, shell=True, check=True,
+    return mirror
+
+
+def clone_vendor(git_uri, name, vendor_path, mirror_dir):
+    # Check out the vendor repo without copying its history: from the
+    # local mirror, sharing its objects, or as a shallow clone.  Returns
+    # where to list tags from.
+    if not mirror_dir:
+        subprocess.run(f"git clone --depth 1 --quiet {git_uri} {vendor_path}", shell=True, check=True,
                        stdout=subprocess.DEVNULL)
-        subprocess.run(f"git remote add origin {git_uri}", cwd=vendor_path,
-                       shell=True, check=True, stdout=subprocess.DEVNULL)
+        return git_uri
+    mirror = update_vendor_mirror(git_uri, name, mirror_dir)
+    subprocess.run(f"git clone --shared --quiet {mirror} {vendor_path}", shell=True, check=True,
+                   stdout=subprocess.DEVNULL)
+    subprocess.run(f"git remote set-url origin {git_uri}", cwd=vendor_path, shell=True, check=True,
+                   stdout=subprocess.DEVNULL)
+    return mirror
+
+
+def wait_for_snapshot(url, timeout, delay=0.5, max_delay=8):
+    # Poll url until the snapshot of a freshly pushed tag can be
+    # downloaded, backing off between tries.  Returns whether it became
+    # ready within timeout.  Progress goes to stderr, stdout is the
+    # archive list make reads.
+    start = time.monotonic()
+    while True:
+        try:
+            with requests.get(url, timeout=30, stream=True) as response:
+                ready = response.status_code == 200
+        except requests.RequestException:
+            ready = False
+        waited = time.monotonic() - start
+        if ready:
+            print(f"vendor snapshot ready after {waited:.1f}s: {url}", file=sys.stderr)
+            return True
+        if waited + delay > timeout:
+            print(f"vendor snapshot not ready after {waited:.1f}s: {url}", file=sys.stderr)
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def update_vendor(tmpdir, manifests, backend, name, git, mirror_dir=None,
+                  snapshot_url=SNAPSHOT_URL, snapshot_timeout=300, stats=None):
+    stats = stats or VendorStats()
+    git_uri = os.path.join(git, name)
+    vendor_path = os.path.join(tmpdir, 'vendor')
+    with stats.phase('clone'):
+        tag_source = clone_vendor(git_uri, name, vendor_path, mirror_dir)
+        vendor_git = os.path.join(vendor_path, '.git')
+        if not os.path.isdir(vendor_git):
+            # initialize a git repo
+            subprocess.run('git init .', cwd=vendor_path, shell=True, check=True,
+                           stdout=subprocess.DEVNULL)
+            subprocess.run(f"git remote add origin {git_uri}", cwd=vendor_path,
+                           shell=True, check=True, stdout=subprocess.DEVNULL)
+    with stats.phase('fingerprint'):
+        fingerprint = backend.fingerprint(tmpdir, manifests)
+        previous = read_vendor_fingerprint(vendor_path)
+    if fingerprint is not None and previous and previous.get('fingerprint') == fingerprint:
+        # Same manifests and lock files as the last vendor update, so
+        # the vendor step would reproduce the tree that is already there
+        stats.measure(backend, vendor_path)
+        return newest_tag(tag_source), previous['config']
     backup_vendor_git = os.path.join(tmpdir, 'clear-linux-vendor-git')
-    subprocess.run(f"cp -a {vendor_git} {backup_vendor_git}", cwd=tmpdir,
-                   shell=True, check=True, stdout=subprocess.DEVNULL)
+    os.rename(vendor_git, backup_vendor_git)
     shutil.rmtree(vendor_path)
-    vendor_cmd = 'cargo vendor ' + ' '.join([f"-s {x}" for x in cargo_paths[:-1]])
-    vendor_cmd += f" --manifest-path {cargo_paths[-1]}"
-    cargo_vendors = subprocess.run(vendor_cmd, cwd=tmpdir, shell=True,
-                                   check=True, stdout=subprocess.PIPE,
-                                   universal_newlines=True).stdout
+    with stats.phase('vendor'):
+        config = backend.vendor(tmpdir, manifests)
+    stats.data['vendored'] = 1
     with open(os.path.join(vendor_path, ".gitattributes"), "w", encoding='utf8') as gafile:
         gafile.write("* text=false\n")
-    subprocess.run(f"cp -a {backup_vendor_git} {vendor_git}", cwd=tmpdir,
-                   shell=True, check=True, stdout=subprocess.DEVNULL)
-    repo = Repo(vendor_path)
-    if not (len(repo.untracked_files) > 0 or repo.is_dirty()):
-        # Always use the newest tag as sometimes a new tag will
-        # be created but the package won't be updated to use it
-        # for a different failure reason.
-        tag = sorted(repo.tags, key=lambda x: x.name, reverse=True)[0]
-        return tag, cargo_vendors
-    subprocess.run('git add .', cwd=vendor_path, shell=True, check=True,
-                   stdout=subprocess.DEVNULL)
-    subprocess.run('git commit -m "vendor update"', cwd=vendor_path,
-                   shell=True, check=True, stdout=subprocess.DEVNULL)
-    gmt = time.gmtime()
-    tag = f"{gmt.tm_year}-{gmt.tm_mon:02d}-{gmt.tm_mday:02d}-{gmt.tm_hour:02d}-{gmt.tm_min:02d}-{gmt.tm_sec:02d}"
-    subprocess.run(f"git tag {tag}", cwd=vendor_path, shell=True,
-                   check=True, stdout=subprocess.DEVNULL)
-    subprocess.run(f"git push origin main:main {tag}", cwd=vendor_path,
-                   shell=True, check=True, stdout=subprocess.DEVNULL)
-    time.sleep(30)
-    return tag, cargo_vendors
-
-
-def update_cargo_sources(name, tag, cargo_vendors):
-    makefile = []
-    options = []
-    archive_match = os.path.join(r'\$\(CGIT_BASE_URL\)', 'vendor', name,
-                                 'snapshot', name)
-    archive_replace = os.path.join('$(CGIT_BASE_URL)', 'vendor', name,
-                                   'snapshot', name)
-    with open('Makefile', encoding='utf8') as mfile:
-        for line in mfile.readlines():
-            if line.startswith('ARCHIVES'):
-                if re.search(archive_match + r'[a-zA-Z0-9_\-.]+\.tar\.gz', line):
-                    new_archives = re.sub(archive_match + r'[a-zA-Z0-9_\-.]+\.tar\.gz',
-                                          f"{archive_replace}-{tag}.tar.gz", line)
-                else:
-                    new_archives = f"{line[:-1]} {archive_replace}-{tag}.tar.gz ./vendor\n"
-                print(new_archives.replace('ARCHIVES = ', '', 1))
-                makefile.append(new_archives)
-            else:
-                makefile.append(line)
-    with open('Makefile', 'w', encoding='utf8') as mfile:
-        mfile.writelines(makefile)
-
-    archive_match = os.path.join('http://localhost', 'cgit', 'vendor', name,
-                                 'snapshot', name)
-    with open('options.conf', encoding='utf8') as ofile:
-        for line in ofile.readlines():
-            if line.startswith('archives'):
-                if re.search(archive_match + r'[a-zA-Z0-9_\-.]+\.tar\.gz', line):
-                    new_archives = re.sub(archive_match + r'[a-zA-Z0-9_\-.]+\.tar\.gz',
-                                          f"{archive_match}-{tag}.tar.gz", line)
-                else:
-                    new_archives = f"{line[:-1]} {archive_match}-{tag}.tar.gz ./vendor\n"
-                options.append(new_archives)
-            else:
-                options.append(line)
-    with open('options.conf', 'w', encoding='utf8') as ofile:
-        ofile.writelines(options)
-    with open('cargo_vendors', 'w', encoding='utf8') as cfile:
-        cfile.write(cargo_vendors)
+    with open(os.path.join(vendor_path, VENDOR_FINGERPRINT), "w", encoding='utf8') as ffile:
+        json.dump({'fingerprint': fingerprint, 'config': config}, ffile, indent=1)
+        ffile.write("\n")
+    os.rename(backup_vendor_git, vendor_git)
+    stats.measure(backend, vendor_path)
+    with stats.phase('commit'):
+        repo = Repo(vendor_path)
+        if not (len(repo.untracked_files) > 0 or repo.is_dirty()):
+            return newest_tag(tag_source), config
+        subprocess.run('git add .', cwd=vendor_path, shell=True, check=True,
+                       stdout=subprocess.DEVNULL)
+        subprocess.run('git commit -m "vendor update"', cwd=vendor_path,
+                       shell=True, check=True, stdout=subprocess.DEVNULL)
+        gmt = time.gmtime()
+        tag = f"{gmt.tm_year}-{gmt.tm_mon:02d}-{gmt.tm_mday:02d}-{gmt.tm_hour:02d}-{gmt.tm_min:02d}-{gmt.tm_sec:02d}"
+        subprocess.run(f"git tag {tag}", cwd=vendor_path, shell=True,
+                       check=True, stdout=subprocess.DEVNULL)
+    with stats.phase('push'):
+        subprocess.run(f"git push origin main:main {tag}", cwd=vendor_path,
+                       shell=True, check=True, stdout=subprocess.DEVNULL)
+    stats.data['tagged'] = 1
+    with stats.phase('snapshot_wait'):
+        wait_for_snapshot(snapshot_url.format(name=name, tag=tag), snapshot_timeout)
+    return tag, config
+
+
+def update_sources(name, tag, backend, config):
+    for archives in pkgmeta.set_vendor_tag(name, tag):
+        print(archives.replace('ARCHIVES = ', '', 1))
+    if backend.config_file:
+        pkgmeta.write_file(backend.config_file, config)
+
+
+def batch_packages(packages_dir, names):
+    # (path, backend name) of the packages to re-vendor
+    if not names:
+        names = sorted(os.listdir(packages_dir))
+    packages = []
+    for name in names:
+        path = os.path.join(packages_dir, name)
+        if vtype := vendor_check(path):
+            packages.append((path, vtype))
+    return packages
+
+
+def batch_download(path, vtype, args, stats):
+    # Download thread: fetch and extract the package's sources
+    return setup_content(pkgmeta.package_url(path), args.cache_dir, args.cache_max_mb, BACKENDS[vtype]().wants,
+                         stats)
+
+
+def batch_vendor(path, vtype, tdir, args, log, data):
+    # Vendor worker process: re-vendor one package from its extracted
+    # sources in tdir, with all output going to log.  data is the stats
+    # of the download, returned with the rest of the run added.
+    start = time.monotonic()
+    name = os.path.basename(path)
+    stats = VendorStats(data=data)
+    cwd = os.getcwd()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    error = None
+    try:
+        with open(log, 'a', encoding='utf8') as lfile:
+            os.dup2(lfile.fileno(), 1)
+            os.dup2(lfile.fileno(), 2)
+            try:
+                os.chdir(path)
+                backend = BACKENDS[vtype]()
+                with stats.phase('discover'):
+                    manifests = backend.discover(tdir)
+                stats.data['manifests'] = len(manifests)
+                if len(manifests) > 0:
+                    tag, config = update_vendor(tdir, manifests, backend, name, args.vendor_git, args.mirror_dir,
+                                                args.snapshot_url, args.snapshot_timeout, stats)
+                    with stats.phase('update_sources'):
+                        update_sources(name, tag, backend, config)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                print(error, file=sys.stderr)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+    finally:
+        os.chdir(cwd)
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+        shutil.rmtree(tdir, ignore_errors=True)
+    return error, time.monotonic() - start, stats.data
+
+
+def batch(args):
+    # Downloads run in a bounded thread pool and hand each package to a
+    # process pool of vendor workers as soon as its sources are ready.
+    # The workers come from a fork server: forking this process while a
+    # download thread holds a requests or ssl lock could deadlock them.
+    # Returns whether every package was vendored.
+    packages = batch_packages(args.packages_dir, args.packages)
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix='vendor-batch-')
+    os.makedirs(log_dir, exist_ok=True)
+    results = {}
+    stats = {path: VendorStats(os.path.basename(path), vtype) for path, vtype in packages}
+    old_tags = {path: pkgmeta.vendor_tag(os.path.basename(path), path) for path, _ in packages}
+    with concurrent.futures.ThreadPoolExecutor(max(1, args.download_jobs)) as downloads, \
+         concurrent.futures.ProcessPoolExecutor(max(1, args.jobs),
+                                                mp_context=multiprocessing.get_context('forkserver')) as workers:
+        fetches = {downloads.submit(batch_download, path, vtype, args, stats[path]): (path, vtype)
+                   for path, vtype in packages}
+        vendoring = {}
+        for future in concurrent.futures.as_completed(fetches):
+            path, vtype = fetches[future]
+            log = os.path.join(log_dir, f"{os.path.basename(path)}.log")
+            try:
+                tdir = future.result()
+            except Exception as e:
+                results[path] = (f"download: {e}", 0.0, stats[path].data)
+                with open(log, 'a', encoding='utf8') as lfile:
+                    print(results[path][0], file=lfile)
+                continue
+            vendoring[workers.submit(batch_vendor, path, vtype, tdir, args, log, stats[path].data)] = path
+        for future in concurrent.futures.as_completed(vendoring):
+            try:
+                results[vendoring[future]] = future.result()
+            except Exception as e:
+                # the worker process died
+                results[vendoring[future]] = (f"{type(e).__name__}: {e}", 0.0, stats[vendoring[future]].data)
+
+    rows = []
+    for path, _ in packages:
+        name = os.path.basename(path)
+        error, seconds, data = results[path]
+        write_stats(args.stats_file, data)
+        old, new = old_tags[path], pkgmeta.vendor_tag(name, path)
+        if error:
+            status = 'FAILED'
+        elif old == new:
+            status = 'unchanged'
+        else:
+            status = 'changed'
+        rows.append((name, old or '-', new or '-', status, f"{seconds:.1f}s"))
+    widths = [max(len(row[i]) for row in rows + [('package', 'old tag', 'new tag', 'status', 'time')])
+              for i in range(5)]
+    for row in [('package', 'old tag', 'new tag', 'status', 'time')] + rows:
+        print('  '.join(col.ljust(width) for col, width in zip(row, widths)).rstrip())
+    changed = sum(1 for row in rows if row[3] == 'changed')
+    failed = sum(1 for row in rows if row[3] == 'FAILED')
+    for path, _ in packages:
+        if error := results[path][0]:
+            print(f"{os.path.basename(path)}: {error}", file=sys.stderr)
+    print(format_stats(merge_stats(result[2] for result in results.values())))
+    print(f"{len(rows)} packages, {changed} changed, {failed} failed; logs in {log_dir}")
+    return failed == 0
 
 
 def main():
     args = get_args()
 
+    if args.summarize_stats:
+        print(format_stats(merge_stats(read_stats(args.summarize_stats))))
+        return
+
+    if args.batch:
+        sys.exit(0 if batch(args) else 1)
+
     vtype = vendor_check()
     if not vtype:
         print(args.archives)
         return
 
-    tdir = setup_content(args.url)
-    if vtype == 'cargo':
-        cargo_paths = setup_cargo_vendor(tdir)
-        if len(cargo_paths) == 0:
-            print(args.archives)
-        else:
-            tag, cargo_vendors = update_cargo_vendor(tdir, cargo_paths, args.name, args.git)
-            update_cargo_sources(args.name, tag, cargo_vendors)
+    backend = BACKENDS[vtype]()
+    stats = VendorStats(args.name, vtype)
+    tdir = setup_content(args.url, args.cache_dir, args.cache_max_mb, backend.wants, stats)
+    with stats.phase('discover'):
+        manifests = backend.discover(tdir)
+    stats.data['manifests'] = len(manifests)
+    if len(manifests) == 0:
+        print(args.archives)
+    else:
+        tag, config = update_vendor(tdir, manifests, backend, args.name, args.git, args.mirror_dir,
+                                    args.snapshot_url, args.snapshot_timeout, stats)
+        with stats.phase('update_sources'):
+            update_sources(args.name, tag, backend, config)
     shutil.rmtree(tdir)
+    write_stats(args.stats_file, stats.data)
 
 
 if __name__ == '__main__':